@@ -15,16 +15,35 @@ import socketserver
 import base64
 import ipaddress
 import signal
-import cgi
 import shlex
-import subprocess
+import shutil
+import tempfile
 import logging
+import threading
+import time
+import struct
+import queue
+import collections
+import itertools
+import http.client
+import concurrent.futures
+import asyncio
+import multiprocessing
 import fnmatch
+import re
 import hashlib
 import mimetypes
+import gzip
+import zlib
+import io
+import email.utils
+import email.parser
+import codecs
+import uuid
 from string import Template
+from stat import S_ISDIR
 from http.server import BaseHTTPRequestHandler
-import urllib.request
+import urllib.error
 from urllib.parse import urlparse, parse_qs, unquote
 
 ### Some options for you to change
@@ -92,6 +111,62 @@ IGNORE_SSL = False
 # Notification service like `notify.mytelegram`. Default is `persistent_notification.create`
 NOTIFY_SERVICE_DEFAULT = "persistent_notification.create"
 NOTIFY_SERVICE = NOTIFY_SERVICE_DEFAULT
+# Seconds the services, events and states fetched from the HASS API are
+# considered fresh. Older data is served while it's being refreshed.
+BOOTSTRAP_TTL = 60
+# Timeout in seconds for requests to the HASS API, and for service calls like
+# check_config, which may take a lot longer.
+HASS_API_TIMEOUT = 10
+HASS_SERVICE_TIMEOUT = 300
+# Keep entities and services up to date by listening to events on the
+# websocket API instead of polling the REST API. Requires HASS_API_PASSWORD.
+LIVE_REGISTRY = True
+# Number of threads handling requests. Connections exceeding the capacity
+# of the workers and the queue are rejected with 503. Set WORKERS to 0 to
+# start a new thread for every connection instead.
+WORKERS = 16
+MAX_QUEUED_CONNECTIONS = 64
+# Number of streamed responses (followed files and command output) served at
+# the same time by the "threads" engine, where each of them keeps a worker
+# busy until the client goes away. Limited to WORKERS - 1, so other requests
+# can still be served. Further streams are rejected with 503. The "asyncio"
+# engine serves streams on its event loop and doesn't limit them.
+MAX_STREAMS = 4
+# Seconds to wait for a client to send a request, and for further data
+# while receiving a request.
+CONNECTION_IDLE_TIMEOUT = 5
+CONNECTION_READ_TIMEOUT = 60
+# Engine serving the connections. "threads" uses blocking sockets handled by
+# the worker threads, "asyncio" waits for clients on an event loop and only
+# uses the WORKERS threads to run the request handlers. Requests waiting for
+# HASS service calls, shell commands or followed files are then finished on
+# the event loop and don't keep one of the WORKERS threads busy.
+SERVER_ENGINE = "threads"
+# Number of processes serving requests. With more than 1, the processes share
+# the port via SO_REUSEPORT (Linux / BSD) and each of them uses WORKERS
+# threads. Banned IPs and allowed networks are kept in sync between them.
+# Shell commands are only known to the process running them, so listing,
+# following and cancelling them via /api/commands, /api/command_output and
+# /api/cancel_command is only available with a single process.
+PROCESSES = 1
+# Seconds the git status of a repository is cached. Changes to the index,
+# HEAD, branches or the listed directory invalidate the cache immediately.
+GIT_STATUS_TTL = 10
+# Number of bytes of recent output kept in memory for every shell command.
+EXEC_OUTPUT_BUFFER = 65536
+# Number of bytes of output returned by /api/exec_command without streaming.
+# Further output is dropped and the result is marked as truncated.
+EXEC_RESULT_MAX_SIZE = 10485760
+# Number of shell commands running at the same time. Further commands wait up
+# to COMMAND_QUEUE_TIMEOUT seconds for a free slot before they are cancelled.
+MAX_COMMANDS = 2
+COMMAND_QUEUE_TIMEOUT = 30
+# Maximum size in bytes of a single upload, and of all unfinished chunked
+# uploads together. Seconds an unfinished chunked upload is kept after the
+# last chunk has been received.
+UPLOAD_MAX_SIZE = 104857600
+UPLOAD_QUOTA = 1073741824
+UPLOAD_TTL = 86400
 ### End of options
 
 LOGLEVEL_MAPPING = {
@@ -118,6 +193,11 @@ TOTP = None
 HTTPD = None
 FAIL2BAN_IPS = {}
 REPO = None
+IGNORE_REGEX = None
+STATIC_CACHE = {}
+INDEX_TEMPLATE = None
+HASS_POOL = None
+HASS_POOL_LOCK = threading.Lock()
 
 ERROR_HTML = """<!DOCTYPE html>
 <html lang="en">
@@ -136,7 +216,13 @@ def signal_handler(sig, frame):
     """Handle signal to shut down server."""
     global HTTPD
     LOG.info("Got signal: %s. Shutting down server", str(sig))
-    HTTPD.server_close()
+    if HTTPD is not None:
+        HTTPD.server_close()
+    if HASS_POOL is not None:
+        HASS_POOL.close()
+    REGISTRY.stop()
+    REPO_POOL.close()
+    COMMANDS.close()
     sys.exit(0)
 
 def load_settings(args):
@@ -145,7 +231,11 @@ def load_settings(args):
     HASS_API_PASSWORD, CREDENTIALS, ALLOWED_NETWORKS, BANNED_IPS, BANLIMIT, \
     DEV, IGNORE_PATTERN, DIRSFIRST, SESAME, VERIFY_HOSTNAME, ENFORCE_BASEPATH, \
     ENV_PREFIX, NOTIFY_SERVICE, USERNAME, PASSWORD, SESAME_TOTP_SECRET, TOTP, \
-    GIT, REPO, PORT, IGNORE_SSL, HASS_WS_API, ALLOWED_DOMAINS, HIDEHIDDEN
+    GIT, REPO, PORT, IGNORE_SSL, HASS_WS_API, ALLOWED_DOMAINS, HIDEHIDDEN, IGNORE_REGEX, \
+    BOOTSTRAP_TTL, HASS_API_TIMEOUT, HASS_SERVICE_TIMEOUT, LIVE_REGISTRY, WORKERS, \
+    MAX_QUEUED_CONNECTIONS, CONNECTION_IDLE_TIMEOUT, CONNECTION_READ_TIMEOUT, SERVER_ENGINE, \
+    PROCESSES, GIT_STATUS_TTL, EXEC_OUTPUT_BUFFER, MAX_COMMANDS, UPLOAD_MAX_SIZE, UPLOAD_QUOTA, \
+    UPLOAD_TTL, COMMAND_QUEUE_TIMEOUT, EXEC_RESULT_MAX_SIZE, MAX_STREAMS
     settings = {}
     settingsfile = args.settings
     if settingsfile:
@@ -214,6 +304,28 @@ def load_settings(args):
         HASS_API = settings.get("HASS_API", HASS_API)
     HASS_WS_API = settings.get("HASS_WS_API", HASS_WS_API)
     HASS_API_PASSWORD = settings.get("HASS_API_PASSWORD", HASS_API_PASSWORD)
+    HASS_API_TIMEOUT = settings.get("HASS_API_TIMEOUT", HASS_API_TIMEOUT)
+    HASS_SERVICE_TIMEOUT = settings.get("HASS_SERVICE_TIMEOUT", HASS_SERVICE_TIMEOUT)
+    BOOTSTRAP_TTL = settings.get("BOOTSTRAP_TTL", BOOTSTRAP_TTL)
+    LIVE_REGISTRY = settings.get("LIVE_REGISTRY", LIVE_REGISTRY)
+    WORKERS = settings.get("WORKERS", WORKERS)
+    MAX_QUEUED_CONNECTIONS = settings.get("MAX_QUEUED_CONNECTIONS", MAX_QUEUED_CONNECTIONS)
+    MAX_STREAMS = settings.get("MAX_STREAMS", MAX_STREAMS)
+    CONNECTION_IDLE_TIMEOUT = settings.get("CONNECTION_IDLE_TIMEOUT", CONNECTION_IDLE_TIMEOUT)
+    CONNECTION_READ_TIMEOUT = settings.get("CONNECTION_READ_TIMEOUT", CONNECTION_READ_TIMEOUT)
+    SERVER_ENGINE = settings.get("SERVER_ENGINE", SERVER_ENGINE)
+    PROCESSES = settings.get("PROCESSES", PROCESSES)
+    GIT_STATUS_TTL = settings.get("GIT_STATUS_TTL", GIT_STATUS_TTL)
+    EXEC_OUTPUT_BUFFER = settings.get("EXEC_OUTPUT_BUFFER", EXEC_OUTPUT_BUFFER)
+    EXEC_RESULT_MAX_SIZE = settings.get("EXEC_RESULT_MAX_SIZE", EXEC_RESULT_MAX_SIZE)
+    MAX_COMMANDS = settings.get("MAX_COMMANDS", MAX_COMMANDS)
+    COMMAND_QUEUE_TIMEOUT = settings.get("COMMAND_QUEUE_TIMEOUT", COMMAND_QUEUE_TIMEOUT)
+    UPLOAD_MAX_SIZE = settings.get("UPLOAD_MAX_SIZE", UPLOAD_MAX_SIZE)
+    UPLOAD_QUOTA = settings.get("UPLOAD_QUOTA", UPLOAD_QUOTA)
+    UPLOAD_TTL = settings.get("UPLOAD_TTL", UPLOAD_TTL)
+    if PROCESSES > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        LOG.warning("SO_REUSEPORT is not supported. Using a single process.")
+        PROCESSES = 1
     CREDENTIALS = settings.get("CREDENTIALS", CREDENTIALS)
     ALLOWED_NETWORKS = settings.get("ALLOWED_NETWORKS", ALLOWED_NETWORKS)
     if ALLOWED_NETWORKS and not all(ALLOWED_NETWORKS):
@@ -248,6 +360,7 @@ def load_settings(args):
     if IGNORE_PATTERN and not all(IGNORE_PATTERN):
         LOG.warning("Invalid value for IGNORE_PATTERN. Using empty list.")
         IGNORE_PATTERN = []
+    IGNORE_REGEX = compile_ignore_pattern(IGNORE_PATTERN)
     if args.dirsfirst:
         DIRSFIRST = args.dirsfirst
     else:
@@ -298,54 +411,311 @@ def is_safe_path(basedir, path, follow_symlinks=True):
         return os.path.realpath(path).startswith(basedir.encode('utf-8'))
     return os.path.abspath(path).startswith(basedir.encode('utf-8'))
 
+def compile_ignore_pattern(patterns):
+    """Combine the IGNORE_PATTERN globs into one regex, or None if empty."""
+    if not patterns:
+        return None
+    return re.compile("|".join(
+        fnmatch.translate(os.path.normcase(pattern)) for pattern in patterns))
+
+class GitStatus: # pylint: disable=too-few-public-methods
+    """Git status of the files below a directory, indexed by full path."""
+    def __init__(self, repo=None, path=None):
+        self.untracked = set()
+        self.staged = set()
+        self.unstaged = set()
+        if repo is None:
+            return
+        # Limit git to the listed subtree instead of the whole repository
+        paths = None
+        relpath = os.path.relpath(os.path.abspath(path), repo.working_dir)
+        if relpath != os.curdir and not relpath.startswith(os.pardir):
+            paths = [":(literal)%s" % relpath.replace(os.sep, '/')]
+        with REPO_POOL.lock(repo):
+            untracked = repo.git.ls_files('--others', '--exclude-standard', '-z',
+                                          '--', *(paths or []))
+            for filename in untracked.split('\0'):
+                if filename:
+                    self.untracked.add(self.fullpath(repo, filename))
+            try:
+                for element in repo.index.diff("HEAD", paths=paths):
+                    self.staged.add(self.fullpath(repo, element.b_path))
+            except Exception as err:
+                LOG.warning("Exception: %s", str(err))
+            for element in repo.index.diff(None, paths=paths):
+                self.unstaged.add(self.fullpath(repo, element.b_path))
+
+    @staticmethod
+    def fullpath(repo, gitpath):
+        """Convert a path reported by git to a full path."""
+        return "%s%s%s" % (repo.working_dir, os.sep, os.sep.join(gitpath.split('/')))
+
+class GitStatusCache:
+    """Cache git status information until the repository changes."""
+    def __init__(self, size=64):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    @staticmethod
+    def signature(repo):
+        """Get the mtimes and sizes of the index, HEAD and refs of a repository."""
+        result = []
+        for name in ('index', 'HEAD', 'packed-refs'):
+            try:
+                stats = os.stat(os.path.join(repo.git_dir, name))
+                result.append((name, stats.st_mtime_ns, stats.st_size))
+            except OSError:
+                result.append((name, None, None))
+        heads = [os.path.join(repo.git_dir, 'refs', 'heads')]
+        while heads:
+            try:
+                with os.scandir(heads.pop()) as iterator:
+                    for entry in iterator:
+                        if entry.is_dir(follow_symlinks=False):
+                            heads.append(entry.path)
+                        else:
+                            stats = entry.stat(follow_symlinks=False)
+                            result.append((entry.path, stats.st_mtime_ns, stats.st_size))
+            except OSError:
+                pass
+        return tuple(result)
+
+    def get(self, key, signature, compute):
+        """Get the value cached for key, compute it if the signature has
+        changed or the value has expired."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == signature and \
+                    now - entry[1] < GIT_STATUS_TTL:
+                return entry[2]
+        value = compute()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (signature, now, value)
+            while len(self.entries) > self.size:
+                del self.entries[next(iter(self.entries))]
+        return value
+
+    def clear(self):
+        """Drop all cached values."""
+        with self.lock:
+            self.entries.clear()
+
+GIT_STATUS_CACHE = GitStatusCache()
+
+class RepoPool:
+    """Keep one Repo object per working tree. Repo objects aren't thread-safe,
+    use `with REPO_POOL.lock(repo):` when working with them."""
+    def __init__(self):
+        self.pool_lock = threading.Lock()
+        self.paths = {}
+        self.repos = {}
+        self.locks = {}
+
+    def get(self, path, search_parent_directories=True):
+        """Get the Repo of the working tree containing path."""
+        key = (os.path.abspath(path), search_parent_directories)
+        with self.pool_lock:
+            working_dir = self.paths.get(key)
+            if working_dir is not None and os.path.exists(working_dir):
+                return self.repos[working_dir]
+        # pylint: disable=not-callable
+        repo = REPO(path, search_parent_directories=search_parent_directories)
+        with self.pool_lock:
+            pooled = self.repos.setdefault(repo.working_dir, repo)
+            self.locks.setdefault(repo.working_dir, threading.RLock())
+            self.paths[key] = repo.working_dir
+        if pooled is not repo:
+            repo.close()
+        return pooled
+
+    def lock(self, repo):
+        """Get the lock serializing operations on a Repo."""
+        with self.pool_lock:
+            return self.locks.setdefault(repo.working_dir, threading.RLock())
+
+    def reset_paths(self):
+        """Resolve paths again, e.g. after a repository has been created."""
+        with self.pool_lock:
+            self.paths.clear()
+
+    def close(self):
+        """Stop the git processes of all Repo objects."""
+        with self.pool_lock:
+            repos = list(self.repos.values())
+            self.repos.clear()
+            self.paths.clear()
+        for repo in repos:
+            try:
+                repo.close()
+            except Exception as err:
+                LOG.warning(err)
+
+REPO_POOL = RepoPool()
+
+GIT_PROGRESS_STAGES = {
+    4: "Counting objects",
+    8: "Compressing objects",
+    16: "Writing objects",
+    32: "Receiving objects",
+    64: "Resolving deltas",
+    128: "Finding sources",
+    256: "Checking out files"
+}
+
+class GitJob: # pylint: disable=too-many-instance-attributes
+    """Git operation running in the background."""
+    def __init__(self, action, path, target):
+        self.job_id = uuid.uuid4().hex
+        self.action = action
+        self.path = path
+        self.target = target
+        self.state = "queued"
+        self.error = False
+        self.message = ""
+        self.progress = {}
+        self.finished = None
+        self.published = 0
+
+    def update(self, op_code, cur_count, max_count=None, message=''):
+        """Progress callback for GitPython."""
+        self.progress = {
+            "stage": GIT_PROGRESS_STAGES.get(op_code & ~3, None),
+            "current": cur_count,
+            "total": max_count,
+            "message": message
+        }
+        self.publish(force=False)
+
+    def publish(self, force=True):
+        """Share the state of the job with the other worker processes."""
+        if SHARED_STATE.store is None:
+            return
+        now = time.time()
+        if force or now - self.published >= 0.5:
+            self.published = now
+            SHARED_STATE.store["gitjob:%s" % self.job_id] = self.as_dict()
+
+    def as_dict(self):
+        """Get the state of the job for the API."""
+        return {
+            "job": self.job_id,
+            "action": self.action,
+            "path": self.path,
+            "state": self.state,
+            "progress": self.progress,
+            "error": self.error,
+            "message": self.message
+        }
+
+class GitJobQueue:
+    """Run git operations talking to remotes one at a time in the background."""
+    def __init__(self, history=20):
+        self.history = history
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def submit(self, action, path, target):
+        """Queue target(job), it returns the message of the finished job."""
+        job = GitJob(action, path, target)
+        with self.lock:
+            finished = [old for old in self.jobs.values() if old.finished]
+            for old in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[old.job_id]
+                if SHARED_STATE.store is not None:
+                    SHARED_STATE.store.pop("gitjob:%s" % old.job_id, None)
+            self.jobs[job.job_id] = job
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="git-jobs",
+                                               daemon=True)
+                self.thread.start()
+        job.publish()
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        """Get the state of a job by its id, it may run in another process."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job.as_dict()
+        if SHARED_STATE.store is not None and job_id:
+            return SHARED_STATE.store.get("gitjob:%s" % job_id)
+        return None
+
+    def _run(self):
+        """Work through the queued jobs."""
+        while True:
+            job = self.queue.get()
+            job.state = "running"
+            job.publish()
+            try:
+                job.message = job.target(job)
+                job.state = "done"
+            except Exception as err:
+                job.error = True
+                job.state = "failed"
+                job.message = str(err)
+                LOG.warning("Git %s failed: %s", job.action, err)
+            job.finished = time.time()
+            job.publish()
+            GIT_STATUS_CACHE.clear()
+
+GIT_JOBS = GitJobQueue()
+
+def git_push(repo, job):
+    """Push to the origin remote, reporting the progress to job."""
+    with REPO_POOL.lock(repo):
+        origin = repo.remotes.origin
+        url = list(origin.urls)[0]
+    # Pushing runs its own git process, the Repo isn't locked meanwhile
+    for info in origin.push(progress=job.update):
+        if info.flags & info.ERROR:
+            raise RuntimeError(info.summary.strip())
+    return "Pushed to %s" % url
+
+def git_repo_info(repo):
+    """Get the active branch, dirty state and branches of a repository."""
+    with REPO_POOL.lock(repo):
+        return repo.active_branch.name, repo.is_dirty(), \
+            [branch.name for branch in repo.branches]
+
 def get_dircontent(path, repo=None):
     """Get content of directory."""
     dircontent = []
-    if repo:
-        untracked = [
-            "%s%s%s"%(repo.working_dir, os.sep, e) for e in \
-            ["%s"%os.sep.join(f.split('/')) for f in repo.untracked_files]
-        ]
-        staged = {}
-        unstaged = {}
-        try:
-            for element in repo.index.diff("HEAD"):
-                staged["%s%s%s" % (repo.working_dir,
-                                   os.sep,
-                                   "%s"%os.sep.join(
-                                       element.b_path.split('/')))] = element.change_type
-        except Exception as err:
-            LOG.warning("Exception: %s", str(err))
-        for element in repo.index.diff(None):
-            unstaged["%s%s%s" % (repo.working_dir,
-                                 os.sep,
-                                 "%s"%os.sep.join(
-                                     element.b_path.split('/')))] = element.change_type
-    else:
-        untracked = []
-        staged = {}
-        unstaged = {}
 
     def sorted_file_list():
-        """Sort list of files / directories."""
-        dirlist = [x for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]
-        filelist = [x for x in os.listdir(path) if not os.path.isdir(os.path.join(path, x))]
-        if HIDEHIDDEN:
-            dirlist = [x for x in dirlist if not x.startswith('.')]
-            filelist = [x for x in filelist if not x.startswith('.')]
+        """Sort list of files / directories, return (entry, isdir) tuples."""
+        entries = []
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                if HIDEHIDDEN and entry.name.startswith('.'):
+                    continue
+                if IGNORE_REGEX is not None and \
+                        IGNORE_REGEX.match(os.path.normcase(entry.name)):
+                    continue
+                try:
+                    isdir = entry.is_dir()
+                except OSError:
+                    isdir = False
+                entries.append((entry, isdir))
         if DIRSFIRST:
-            return sorted(dirlist, key=lambda x: x.lower()) + \
-                sorted(filelist, key=lambda x: x.lower())
-        return sorted(dirlist + filelist, key=lambda x: x.lower())
+            return sorted(entries, key=lambda x: (not x[1], x[0].name.lower()))
+        return sorted(entries, key=lambda x: x[0].name.lower())
 
-    for elem in sorted_file_list():
+    abspath = os.path.abspath(path)
+    for entry, isdir in sorted_file_list():
         edata = {}
-        edata['name'] = elem
+        edata['name'] = entry.name
         edata['dir'] = path
-        edata['fullpath'] = os.path.abspath(os.path.join(path, elem))
-        edata['type'] = 'dir' if os.path.isdir(edata['fullpath']) else 'file'
+        edata['fullpath'] = os.path.join(abspath, entry.name)
+        edata['type'] = 'dir' if isdir else 'file'
         try:
-            stats = os.stat(os.path.join(path, elem))
+            stats = entry.stat()
             edata['size'] = stats.st_size
             edata['modified'] = stats.st_mtime
             edata['created'] = stats.st_ctime
@@ -353,24 +723,25 @@ def get_dircontent(path, repo=None):
             edata['size'] = 0
             edata['modified'] = 0
             edata['created'] = 0
+        dircontent.append(edata)
+
+    if repo:
+        worktree = tuple((edata['name'], edata['size'], edata['modified'])
+                         for edata in dircontent)
+        status = GIT_STATUS_CACHE.get(
+            (repo.working_dir, abspath), (GIT_STATUS_CACHE.signature(repo), worktree),
+            lambda: GitStatus(repo, path))
+    else:
+        status = GitStatus()
+    for edata in dircontent:
         edata['changetype'] = None
         edata['gitstatus'] = bool(repo)
-        edata['gittracked'] = 'untracked' if edata['fullpath'] in untracked else 'tracked'
-        if edata['fullpath'] in unstaged:
+        edata['gittracked'] = 'untracked' \
+            if edata['fullpath'] in status.untracked else 'tracked'
+        if edata['fullpath'] in status.unstaged:
             edata['gitstatus'] = 'unstaged'
-            edata['changetype'] = unstaged.get(edata['name'], None)
-        elif edata['fullpath'] in staged:
+        elif edata['fullpath'] in status.staged:
             edata['gitstatus'] = 'staged'
-            edata['changetype'] = staged.get(edata['name'], None)
-
-        hidden = False
-        if IGNORE_PATTERN is not None:
-            for file_pattern in IGNORE_PATTERN:
-                if fnmatch.fnmatch(edata['name'], file_pattern):
-                    hidden = True
-
-        if not hidden:
-            dircontent.append(edata)
 
     return dircontent
 
@@ -386,6 +757,38 @@ def load_file(filename, static=False):
         LOG.critical(err)
         return None
 
+def find_line_start(fptr, end, lines, limit):
+    """Return the offset of the line lines lines before end, scanning the file
+    backwards in blocks. Doesn't go back further than limit bytes."""
+    pos = end
+    stop = max(end - limit, 0)
+    # A line break right before end terminates the last line
+    search_end = end - 1
+    while pos > stop:
+        size = min(FILE_CHUNK_SIZE, pos - stop)
+        pos -= size
+        fptr.seek(pos)
+        block = fptr.read(size)
+        index = min(len(block), search_end - pos)
+        while True:
+            index = block.rfind(b"\n", 0, index)
+            if index < 0:
+                break
+            lines -= 1
+            if not lines:
+                return pos + index + 1
+    return stop
+
+def int_param(query, name, default, minimum, maximum=sys.maxsize):
+    """Get an integer query parameter, limited to minimum..maximum. Raises
+    ValueError if it isn't an integer."""
+    value = query.get(name, [str(default)])[0]
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError("Invalid %s: %s" % (name, value)) from None
+    return max(minimum, min(value, maximum))
+
 def password_problems(password, name="UNKNOWN"):
     """Rudimentary checks for password strength."""
     problems = 0
@@ -410,6 +813,81 @@ def password_problems(password, name="UNKNOWN"):
         problems += 8
     return problems
 
+class SharedState:
+    """Keep ALLOWED_NETWORKS, BANNED_IPS and FAIL2BAN_IPS in sync between
+    processes. Changes have to be made within `with SHARED_STATE:`. Also
+    distributes the bootstrap data of the first worker process.
+
+    The state is kept by a multiprocessing manager, which is only asked for it
+    after the version counters in shared memory have changed."""
+    def __init__(self):
+        self.store = None
+        self.lock = None
+        self.version = 0
+        self.changes = None
+        self.bootstrap_version = None
+        self.bootstrap_wanted = None
+        self._bootstrap = (0, None)
+
+    def attach(self, context):
+        """Start sharing the current state with processes forked from context."""
+        self.lock = context.Lock()
+        self.changes = context.Value('Q', self.version, lock=False)
+        self.bootstrap_version = context.Value('Q', 0, lock=False)
+        self.bootstrap_wanted = context.Value('b', 0, lock=False)
+        self.store = context.Manager().dict()
+        self.store['state'] = self._dump()
+
+    def _dump(self):
+        return {
+            "version": self.version,
+            "ALLOWED_NETWORKS": list(ALLOWED_NETWORKS),
+            "BANNED_IPS": list(BANNED_IPS),
+            "FAIL2BAN_IPS": dict(FAIL2BAN_IPS)
+        }
+
+    def pull(self):
+        """Load the state if it has been changed by another process."""
+        if self.store is None or self.changes.value == self.version:
+            return
+        state = self.store['state']
+        ALLOWED_NETWORKS[:] = state["ALLOWED_NETWORKS"]
+        BANNED_IPS[:] = state["BANNED_IPS"]
+        FAIL2BAN_IPS.clear()
+        FAIL2BAN_IPS.update(state["FAIL2BAN_IPS"])
+        self.version = state["version"]
+
+    def __enter__(self):
+        if self.store is not None:
+            self.lock.acquire() # pylint: disable=consider-using-with
+            self.pull()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.store is None:
+            return
+        try:
+            self.version = self.changes.value + 1
+            self.store['state'] = self._dump()
+            self.changes.value = self.version
+        finally:
+            self.lock.release()
+
+    def publish_bootstrap(self, bootstrap):
+        """Share the bootstrap data with the other processes."""
+        self.store['bootstrap'] = bootstrap
+        self.bootstrap_version.value += 1
+
+    def bootstrap(self):
+        """Get the bootstrap data published by the first worker process."""
+        self.bootstrap_wanted.value = 1
+        version = self.bootstrap_version.value
+        if self._bootstrap[0] != version or self._bootstrap[1] is None:
+            self._bootstrap = (version, self.store.get('bootstrap') or dict(BOOTSTRAP_EMPTY))
+        return self._bootstrap[1]
+
+SHARED_STATE = SharedState()
+
 def check_access(clientip):
     """Check if IP is allowed to access the configurator / API."""
     global BANNED_IPS
@@ -435,9 +913,560 @@ def check_access(clientip):
                     if res[4][0] == clientip:
                         return True
         LOG.warning("Client IP not within allowed domains.")
-    BANNED_IPS.append(clientip)
+    with SHARED_STATE:
+        BANNED_IPS.append(clientip)
     return False
 
+def hass_ws_url():
+    """Get the URL of the HASS websocket API."""
+    if HASS_WS_API:
+        return HASS_WS_API
+    if not HASS_API:
+        return ""
+    protocol, uri = HASS_API.split("//")
+    return "%s://%swebsocket" % (
+        "wss" if protocol == 'https' else 'ws', uri
+    )
+
+def hass_api_headers():
+    """Build the headers required for requests to the HASS API."""
+    headers = {
+        "Content-Type": "application/json"
+    }
+    if HASS_API_PASSWORD:
+        if is_jwt(HASS_API_PASSWORD):
+            headers["Authorization"] = "Bearer %s" % HASS_API_PASSWORD
+        else:
+            headers["x-ha-access"] = HASS_API_PASSWORD
+    return headers
+
+class HassConnectionPool:
+    """Pool of persistent HTTP connections to the HASS API."""
+    def __init__(self, url, size=3):
+        parsed = urlparse(url)
+        self.url = url
+        self.size = size
+        self._https = parsed.scheme == 'https'
+        self._netloc = parsed.netloc
+        self._path = parsed.path or '/'
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self, timeout):
+        """Open a new connection."""
+        if self._https:
+            return http.client.HTTPSConnection(
+                self._netloc, timeout=timeout,
+                # pylint: disable=protected-access
+                context=ssl._create_default_https_context())
+        return http.client.HTTPConnection(self._netloc, timeout=timeout)
+
+    def _release(self, conn):
+        """Return a connection to the pool or close it if the pool is full."""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, endpoint, body=None, headers=None, timeout=None):
+        """Perform a request and return the body of the response."""
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect(timeout)
+            else:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, self._path + endpoint, body=body,
+                             headers=headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except ConnectionError:
+                conn.close()
+                if reused:
+                    # Idle connection has been closed by HASS, try another one
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if response.status >= 400:
+                raise urllib.error.HTTPError(self.url + endpoint, response.status,
+                                             response.reason, response.headers, None)
+            return data
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+def hass_api_request(method, endpoint, data=None, timeout=None):
+    """Send a request to the HASS API and return the decoded response. The
+    timeout defaults to HASS_API_TIMEOUT."""
+    global HASS_POOL
+    with HASS_POOL_LOCK:
+        if HASS_POOL is None or HASS_POOL.url != HASS_API:
+            if HASS_POOL is not None:
+                HASS_POOL.close()
+            HASS_POOL = HassConnectionPool(HASS_API)
+        pool = HASS_POOL
+    body = None
+    if data is not None:
+        body = bytes(json.dumps(data).encode('utf-8'))
+    if timeout is None:
+        timeout = HASS_API_TIMEOUT
+    return pool.request(method, endpoint, body, hass_api_headers(), timeout).decode('utf-8')
+
+def fetch_bootstrap():
+    """Fetch services, events and states from the HASS API."""
+    endpoints = ("services", "events", "states")
+    if REGISTRY.ready:
+        # Services and states are maintained by the websocket registry
+        endpoints = ("events",)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        futures = {
+            endpoint: executor.submit(hass_api_request, 'GET', endpoint)
+            for endpoint in endpoints
+        }
+        bootstrap = {endpoint: future.result() for endpoint, future in futures.items()}
+    if "states" not in bootstrap:
+        return bootstrap
+    states_clean = []
+    for state in json.loads(bootstrap["states"]):
+        states_clean.append(
+            {
+                "entity_id": state.get("entity_id", ""),
+                "attributes":
+                {"friendly_name": state.get("attributes", {}).get(
+                    "friendly_name", state.get("entity_id", ""))}
+            }
+        )
+    bootstrap["states"] = json.dumps(states_clean)
+    return bootstrap
+
+BOOTSTRAP_EMPTY = {"services": "[]", "events": "[]", "states": "[]"}
+
+class BootstrapCache:
+    """Shared cache for the bootstrap data fetched from the HASS API."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._data = None
+        self._updated = 0
+        self._refreshing = False
+        # Use the data published by the first worker process
+        self.shared = False
+
+    def _fetch(self):
+        """Fetch fresh data and store it. Keep the last data if that fails."""
+        try:
+            data = fetch_bootstrap()
+        except Exception as err:
+            LOG.warning("Exception getting bootstrap")
+            LOG.warning(err)
+            with self._lock:
+                if self._data is None:
+                    # Serve empty data without marking it as fresh, so the
+                    # next request tries again
+                    self._data = dict(BOOTSTRAP_EMPTY)
+                return self._data
+        with self._lock:
+            self._data = data
+            self._updated = time.monotonic()
+        return data
+
+    def _refresh(self):
+        """Refresh the data, used as target of the background thread."""
+        try:
+            with self._fetch_lock:
+                self._fetch()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def refresh_async(self):
+        """Start a background refresh unless one is already running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, name="bootstrap", daemon=True).start()
+
+    def get(self, refresh=True):
+        """Return the bootstrap data, only blocking if there is none yet."""
+        if self.shared:
+            return SHARED_STATE.bootstrap()
+        live = REGISTRY.ready
+        with self._lock:
+            data = self._data
+            stale = time.monotonic() - self._updated >= BOOTSTRAP_TTL
+        if data is not None and not live and "states" not in data:
+            # Fetched while the registry was online, services and states are missing
+            stale = True
+        if data is None:
+            with self._fetch_lock:
+                with self._lock:
+                    data = self._data
+                if data is None:
+                    data = self._fetch()
+        elif stale and refresh:
+            self.refresh_async()
+        bootstrap = dict(BOOTSTRAP_EMPTY)
+        bootstrap.update(data)
+        if live:
+            bootstrap.update(REGISTRY.snapshot())
+        return bootstrap
+
+BOOTSTRAP = BootstrapCache()
+
+def publish_bootstrap(interval=1):
+    """Keep the bootstrap data of the other worker processes up to date."""
+    published = None
+    while True:
+        try:
+            # Only refresh stale data if the other processes are using it
+            wanted = SHARED_STATE.bootstrap_wanted.value
+            SHARED_STATE.bootstrap_wanted.value = 0
+            bootstrap = BOOTSTRAP.get(refresh=bool(wanted))
+            # Unchanged data is made of the same objects
+            if published is None or any(
+                    value is not published.get(key) for key, value in bootstrap.items()):
+                SHARED_STATE.publish_bootstrap(bootstrap)
+                published = bootstrap
+        except Exception as err:
+            LOG.warning("Exception publishing bootstrap: %s", err)
+        time.sleep(interval)
+
+class HassWebsocket:
+    """Minimal websocket client (RFC 6455) for the HASS websocket API."""
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        self._sock = None
+        self._buffer = bytearray()
+
+    def connect(self):
+        """Open the connection and perform the opening handshake."""
+        parsed = urlparse(self.url)
+        secure = parsed.scheme == 'wss'
+        port = parsed.port or (443 if secure else 80)
+        sock = socket.create_connection((parsed.hostname, port), timeout=self.timeout)
+        if secure:
+            # pylint: disable=protected-access
+            context = ssl._create_default_https_context()
+            sock = context.wrap_socket(sock, server_hostname=parsed.hostname)
+        self._sock = sock
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        request = "GET %s HTTP/1.1\r\n" \
+            "Host: %s\r\n" \
+            "Upgrade: websocket\r\n" \
+            "Connection: Upgrade\r\n" \
+            "Sec-WebSocket-Key: %s\r\n" \
+            "Sec-WebSocket-Version: 13\r\n\r\n" % (
+                parsed.path or '/', parsed.netloc, key)
+        sock.sendall(request.encode('ascii'))
+        while b"\r\n\r\n" not in self._buffer:
+            self._recv()
+        head, _, rest = bytes(self._buffer).partition(b"\r\n\r\n")
+        self._buffer = bytearray(rest)
+        lines = head.decode('latin-1').split("\r\n")
+        if len(lines[0].split()) < 2 or lines[0].split()[1] != "101":
+            raise ConnectionError("Websocket handshake failed: %s" % lines[0])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1(
+            (key + self.GUID).encode('ascii')).digest()).decode('ascii')
+        if headers.get("sec-websocket-accept") != accept:
+            raise ConnectionError("Websocket handshake failed: invalid accept key")
+
+    def _recv(self):
+        """Read available data from the socket into the buffer."""
+        data = self._sock.recv(65536)
+        if not data:
+            raise ConnectionError("Websocket connection closed")
+        self._buffer.extend(data)
+
+    def _send_frame(self, opcode, payload):
+        """Send a single masked frame."""
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header.append(0x80 | length)
+        elif length < 65536:
+            header.append(0x80 | 126)
+            header.extend(struct.pack("!H", length))
+        else:
+            header.append(0x80 | 127)
+            header.extend(struct.pack("!Q", length))
+        mask = os.urandom(4)
+        header.extend(mask)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self._sock.sendall(bytes(header) + masked)
+
+    def _parse_frame(self):
+        """Take a complete frame from the buffer or return None."""
+        buf = self._buffer
+        if len(buf) < 2:
+            return None
+        length = buf[1] & 0x7f
+        pos = 2
+        if length == 126:
+            if len(buf) < 4:
+                return None
+            length = struct.unpack("!H", buf[2:4])[0]
+            pos = 4
+        elif length == 127:
+            if len(buf) < 10:
+                return None
+            length = struct.unpack("!Q", buf[2:10])[0]
+            pos = 10
+        mask = None
+        if buf[1] & 0x80:
+            mask = buf[pos:pos + 4]
+            pos += 4
+        if len(buf) < pos + length:
+            return None
+        payload = bytes(buf[pos:pos + length])
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        fin = bool(buf[0] & 0x80)
+        opcode = buf[0] & 0x0f
+        del buf[:pos + length]
+        return fin, opcode, payload
+
+    def send_json(self, data):
+        """Send a JSON message."""
+        self._send_frame(0x1, json.dumps(data).encode('utf-8'))
+
+    def recv_json(self):
+        """Receive the next JSON message."""
+        message = b""
+        while True:
+            frame = self._parse_frame()
+            if frame is None:
+                self._recv()
+                continue
+            fin, opcode, payload = frame
+            if opcode == 0x8:
+                raise ConnectionError("Websocket closed by server")
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+            message += payload
+            if fin:
+                return json.loads(message.decode('utf-8'))
+
+    def close(self):
+        """Close the connection."""
+        if self._sock is not None:
+            try:
+                self._send_frame(0x8, b"")
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+
+# pylint: disable=too-many-instance-attributes
+class EntityRegistry:
+    """Entities and services of HASS, kept up to date via the websocket API."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._websocket = None
+        self._states = {}
+        self._services = {}
+        self._version = 0
+        self._snapshot = None
+        self.ready = False
+
+    def start(self):
+        """Start the background thread maintaining the registry."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="registry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self._stop.set()
+        websocket = self._websocket
+        if websocket is not None:
+            websocket.close()
+        self._thread = None
+
+    def _run(self):
+        """Keep a websocket session open, reconnecting with backoff."""
+        backoff = 5
+        while not self._stop.is_set():
+            try:
+                self._session()
+                backoff = 5
+            except Exception as err:
+                if self._stop.is_set():
+                    break
+                LOG.warning("Websocket connection to HASS failed: %s", err)
+            self.ready = False
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, 300)
+
+    def _session(self):
+        """Authenticate, load the initial data and process events."""
+        websocket = HassWebsocket(hass_ws_url(), HASS_API_TIMEOUT)
+        self._websocket = websocket
+        try:
+            websocket.connect()
+            message = websocket.recv_json()
+            if message.get("type") == "auth_required":
+                if is_jwt(HASS_API_PASSWORD):
+                    websocket.send_json({"type": "auth", "access_token": HASS_API_PASSWORD})
+                else:
+                    websocket.send_json({"type": "auth", "api_password": HASS_API_PASSWORD})
+                message = websocket.recv_json()
+            if message.get("type") != "auth_ok":
+                raise ConnectionError("Websocket authentication failed: %s" % message)
+            # Message ids have to increase with every message of the session
+            msgids = itertools.count(1)
+            # Subscribe first to not miss changes while loading the initial data
+            commands = {}
+            for event_type in ("state_changed", "service_registered", "service_removed",
+                               "entity_registry_updated"):
+                msgid = next(msgids)
+                websocket.send_json(
+                    {"id": msgid, "type": "subscribe_events", "event_type": event_type})
+                commands[msgid] = event_type
+            states_id = next(msgids)
+            websocket.send_json({"id": states_id, "type": "get_states"})
+            services_id = next(msgids)
+            websocket.send_json({"id": services_id, "type": "get_services"})
+            pending = set([states_id, services_id])
+            pinged = False
+            while not self._stop.is_set():
+                try:
+                    message = websocket.recv_json()
+                except socket.timeout:
+                    if pinged:
+                        raise ConnectionError("Websocket connection timed out") from None
+                    websocket.send_json({"id": next(msgids), "type": "ping"})
+                    pinged = True
+                    continue
+                pinged = False
+                if message.get("type") == "event":
+                    self._handle_event(message.get("event", {}))
+                elif message.get("type") == "result":
+                    msgid = message.get("id")
+                    if not message.get("success"):
+                        LOG.debug("Websocket command %s failed: %s",
+                                  commands.get(msgid, msgid), message.get("error"))
+                    elif msgid == states_id:
+                        self._load_states(message.get("result") or [])
+                    elif msgid == services_id:
+                        self._load_services(message.get("result") or {})
+                    pending.discard(msgid)
+                    if not pending and not self.ready:
+                        LOG.info("Entity registry synchronized via websocket")
+                        self.ready = True
+        finally:
+            self._websocket = None
+            websocket.close()
+
+    def _load_states(self, states):
+        """Replace all entities with the result of get_states."""
+        with self._lock:
+            self._states = {}
+            for state in states:
+                self._set_state(state)
+            self._version += 1
+
+    def _load_services(self, services):
+        """Replace all services with the result of get_services."""
+        with self._lock:
+            self._services = services
+            self._version += 1
+
+    def _set_state(self, state):
+        """Store the relevant parts of a state object, return if they changed."""
+        entity_id = state.get("entity_id", "")
+        name = state.get("attributes", {}).get("friendly_name", entity_id)
+        if self._states.get(entity_id) == name:
+            return False
+        self._states[entity_id] = name
+        return True
+
+    def _handle_event(self, event):
+        """Apply a change announced by an event."""
+        event_type = event.get("event_type")
+        data = event.get("data", {})
+        changed = False
+        with self._lock:
+            if event_type == "state_changed":
+                if data.get("new_state"):
+                    changed = self._set_state(data["new_state"])
+                else:
+                    changed = self._states.pop(data.get("entity_id"), None) is not None
+            elif event_type == "service_registered":
+                services = self._services.setdefault(data.get("domain"), {})
+                if data.get("service") not in services:
+                    services[data.get("service")] = {}
+                    changed = True
+            elif event_type == "service_removed":
+                services = self._services.get(data.get("domain"), {})
+                changed = services.pop(data.get("service"), None) is not None
+            elif event_type == "entity_registry_updated":
+                if data.get("action") == "remove":
+                    changed = self._states.pop(data.get("entity_id"), None) is not None
+                elif data.get("old_entity_id"):
+                    changed = self._states.pop(data.get("old_entity_id"), None) is not None
+            if changed:
+                self._version += 1
+
+    def states(self, prefix=None):
+        """Return the entities in the format used for bootstrapping."""
+        with self._lock:
+            return [
+                {"entity_id": entity_id, "attributes": {"friendly_name": name}}
+                for entity_id, name in sorted(self._states.items())
+                if not prefix or entity_id.startswith(prefix)
+            ]
+
+    def snapshot(self):
+        """Return services and states as JSON, encoded once per change."""
+        with self._lock:
+            if self._snapshot is not None and self._snapshot[0] == self._version:
+                return self._snapshot[1]
+            version = self._version
+            services = [
+                {"domain": domain, "services": services}
+                for domain, services in sorted(self._services.items())
+            ]
+        snapshot = {
+            "services": json.dumps(services),
+            "states": json.dumps(self.states())
+        }
+        with self._lock:
+            self._snapshot = (version, snapshot)
+        return snapshot
+
+REGISTRY = EntityRegistry()
+
 def verify_hostname(request_hostname):
     """Verify the provided host header is correct."""
     if VERIFY_HOSTNAME:
@@ -445,33 +1474,1009 @@ def verify_hostname(request_hostname):
             return False
     return True
 
+STATIC_FILES = {
+    "jquery-3.6.0.min.js": "application/javascript",
+    "flUhRq6tzZclQEJ-Vdg-IuiaDsNc.woff2": "font/woff",
+    "js-yaml.min.js": "application/javascript",
+    "materialize.min.js": "application/javascript",
+    "material-icons.fallback.css": "text/css",
+    "style.css": "text/css"
+}
+# Files that are already compressed and won't benefit from Content-Encoding
+STATIC_PRECOMPRESSED = ["flUhRq6tzZclQEJ-Vdg-IuiaDsNc.woff2"]
+# Files with the version in their name. Their content never changes.
+STATIC_IMMUTABLE = ["jquery-3.6.0.min.js", "flUhRq6tzZclQEJ-Vdg-IuiaDsNc.woff2"]
+CACHE_CONTROL_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_CONTROL_REVALIDATE = "no-cache"
+# Generated responses smaller than this are not worth compressing
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_CACHE_SIZE = 16
+COMPRESSION_CACHE = {}
+COMPRESSION_LOCK = threading.Lock()
+
+def static_entry(filename, data, compressors=None):
+    """Build the cache entry for a static file."""
+    variants = {"identity": data}
+    if filename not in STATIC_PRECOMPRESSED:
+        for encoding, compress in (compressors or {}).items():
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                variants[encoding] = compressed
+    try:
+        modified = int(os.path.getmtime(
+            os.path.join(os.path.dirname(os.path.realpath(__file__)), filename)))
+    except OSError:
+        modified = None
+    return {
+        "mimetype": STATIC_FILES[filename],
+        "variants": variants,
+        "etag": 'W/"%s"' % hashlib.sha1(data).hexdigest(),
+        "modified": modified
+    }
+
+def load_static_files():
+    """Load static files into memory and precompute compressed variants."""
+    compressors = {"gzip": lambda data: gzip.compress(data, compresslevel=9)}
+    try:
+        # pylint: disable=import-outside-toplevel
+        import brotli
+        compressors["br"] = brotli.compress
+    except ImportError:
+        LOG.debug("Brotli module not available, serving gzip only")
+    for filename in STATIC_FILES:
+        data = load_file(filename, static=True)
+        if data is None:
+            continue
+        STATIC_CACHE[filename] = static_entry(filename, data, compressors)
+        LOG.debug("Cached %s: %s", filename, ", ".join(
+            "%s=%i" % (k, len(v)) for k, v in STATIC_CACHE[filename]["variants"].items()))
+
+def gzip_cached(etag, data):
+    """Compress data with gzip, reusing the result for known ETags."""
+    with COMPRESSION_LOCK:
+        compressed = COMPRESSION_CACHE.get(etag)
+    if compressed is None:
+        compressed = gzip.compress(data, compresslevel=6)
+        with COMPRESSION_LOCK:
+            COMPRESSION_CACHE[etag] = compressed
+            while len(COMPRESSION_CACHE) > COMPRESSION_CACHE_SIZE:
+                COMPRESSION_CACHE.pop(next(iter(COMPRESSION_CACHE)))
+    return compressed
+
+def is_not_modified(headers, etag, modified=None):
+    """Check conditional request headers against the current representation."""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        opaque = etag[2:] if etag.startswith("W/") else etag
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if (tag[2:] if tag.startswith("W/") else tag) == opaque:
+                return True
+        return False
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since and modified is not None:
+        try:
+            return modified <= email.utils.mktime_tz(
+                email.utils.parsedate_tz(if_modified_since))
+        except (TypeError, ValueError, OverflowError):
+            return False
+    return False
+
+MAX_RANGES = 16
+
+def parse_range(header, size):
+    """Parse a Range header into sorted, non-overlapping (start, end) positions.
+
+    Return None if the header has to be ignored and an empty list if none of
+    the ranges can be satisfied.
+    """
+    unit, _, specs = header.partition("=")
+    specs = specs.split(",")
+    if unit.strip().lower() != "bytes" or len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        match = re.fullmatch(r"\s*(\d*)-(\d*)\s*", spec)
+        if match is None or match.group(1) == match.group(2) == "":
+            return None
+        first, last = match.groups()
+        if not first:
+            # The last bytes of the file
+            start, end = max(size - int(last), 0), size - 1
+            if not int(last):
+                continue
+        else:
+            start, end = int(first), size - 1
+            if last:
+                if int(last) < start:
+                    return None
+                end = min(int(last), end)
+        if start < size:
+            ranges.append((start, end))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def if_range_matches(headers, etag, modified):
+    """Check whether a Range header applies to the current representation."""
+    if_range = headers.get('If-Range')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Only strong validators may be used
+        return if_range == etag
+    try:
+        return modified == email.utils.mktime_tz(email.utils.parsedate_tz(if_range))
+    except (TypeError, ValueError, OverflowError):
+        return False
+
+def compile_index_template():
+    """Split dev.html into prerendered chunks and per-request placeholders."""
+    content = load_file("dev.html", static=True)
+    if content is None:
+        return None
+    static = {
+        "current": VERSION,
+        "versionclass": "",
+        "githidden": "" if GIT else "hiddendiv",
+        # pylint: disable=anomalous-backslash-in-string
+        "separator": "\%s" % os.sep if os.sep == "\\" else os.sep,
+        "listening_address": "%s://%s:%i" % (
+            'https' if SSL_CERTIFICATE else 'http', LISTENIP, PORT),
+        "hass_api_address": "%s" % (HASS_API, ),
+        "hass_ws_address": hass_ws_url(),
+        "api_password": HASS_API_PASSWORD if HASS_API_PASSWORD else "",
+        "standalone": "" if HASS_API else "toggle_hass_panels();"
+    }
+    dynamic = ["loadfile", "your_address"]
+    html = content.decode('utf-8')
+    parts = []
+    chunk = []
+    last = 0
+    # Same semantics as Template.safe_substitute, unknown placeholders are kept
+    for match in Template.pattern.finditer(html):
+        chunk.append(html[last:match.start()])
+        last = match.end()
+        name = match.group('named') or match.group('braced')
+        if match.group('escaped') is not None:
+            chunk.append(Template.delimiter)
+        elif name in static:
+            chunk.append(static[name])
+        elif name in dynamic:
+            parts.append(bytes("".join(chunk), "utf8"))
+            parts.append(name)
+            chunk = []
+        else:
+            chunk.append(match.group())
+    chunk.append(html[last:])
+    parts.append(bytes("".join(chunk), "utf8"))
+    return parts
+
+def render_index(template, **values):
+    """Render a template created by compile_index_template."""
+    return b"".join(
+        part if isinstance(part, bytes) else bytes(values.get(part, ""), "utf8")
+        for part in template)
+
+def accepted_encodings(header):
+    """Parse Accept-Encoding header into a list of acceptable codings."""
+    encodings = []
+    for element in (header or "").split(","):
+        parts = element.strip().split(";")
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            encodings.append(coding)
+    return encodings
+
+class Router:
+    """Precompiled mapping of request paths to handler methods.
+
+    Routes are looked up by the trailing segments of the request path, so a
+    path with an additional prefix (e.g. when running behind a reverse proxy)
+    resolves to the same handler.
+    """
+    def __init__(self):
+        self._exact = {}
+        self._depths = {}
+
+    def add(self, method, path, handler):
+        """Register handler for requests ending with path."""
+        self._exact.setdefault(method, {})[path] = handler
+        depths = set(self._depths.get(method, ()))
+        depths.add(path.count('/'))
+        self._depths[method] = tuple(sorted(depths, reverse=True))
+
+    def resolve(self, method, path):
+        """Return the name of the handler method for path or None."""
+        exact = self._exact.get(method)
+        if exact:
+            segments = path.split('/')
+            for depth in self._depths[method]:
+                if len(segments) <= depth:
+                    continue
+                handler = exact.get("/%s" % "/".join(segments[-depth:]))
+                if handler is not None:
+                    return handler
+        return None
+
+    def routes(self):
+        """Return the route table as a list of dictionaries."""
+        table = []
+        for method, exact in self._exact.items():
+            for path, handler in exact.items():
+                table.append({"method": method, "path": path, "handler": handler})
+        return table
+
+class MultipartParser:
+    """Streaming parser for multipart/form-data request bodies."""
+    chunk_size = 65536
+    max_header_size = 16384
+
+    def __init__(self, rfile, boundary, length):
+        self.rfile = rfile
+        self.remaining = length
+        self.delimiter = b"\r\n--" + boundary
+        # The first delimiter isn't preceded by a line break
+        self.buffer = bytearray(b"\r\n")
+
+    def _fill(self):
+        """Read the next chunk of the body into the buffer."""
+        if self.remaining <= 0:
+            raise ValueError("Incomplete multipart body")
+        data = self.rfile.read(min(self.chunk_size, self.remaining))
+        if not data:
+            raise ValueError("Incomplete multipart body")
+        self.remaining -= len(data)
+        self.buffer += data
+
+    def next_part(self):
+        """Skip to the next part and return its headers, None after the last part."""
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0 and len(self.buffer) >= index + len(self.delimiter) + 2:
+                break
+            if index < 0 and len(self.buffer) >= len(self.delimiter):
+                del self.buffer[:1 - len(self.delimiter)]
+            self._fill()
+        index += len(self.delimiter)
+        final = self.buffer[index:index + 2] == b"--"
+        del self.buffer[:index + 2]
+        if final:
+            return None
+        while not self.buffer.startswith(b"\r\n"):
+            end = self.buffer.find(b"\r\n\r\n")
+            if end >= 0:
+                headers = email.parser.BytesHeaderParser().parsebytes(bytes(self.buffer[:end]))
+                del self.buffer[:end + 4]
+                return headers
+            if len(self.buffer) > self.max_header_size:
+                raise ValueError("Multipart headers too large")
+            self._fill()
+        del self.buffer[:2]
+        return email.parser.BytesHeaderParser().parsebytes(b"")
+
+    def read(self):
+        """Yield the data of the current part in chunks."""
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if index:
+                    yield bytes(self.buffer[:index])
+                del self.buffer[:index]
+                return
+            if len(self.buffer) > keep:
+                yield bytes(self.buffer[:-keep])
+                del self.buffer[:-keep]
+            self._fill()
+
+    def drain(self):
+        """Read the rest of the body."""
+        while self.remaining > 0:
+            data = self.rfile.read(min(self.chunk_size, self.remaining))
+            if not data:
+                break
+            self.remaining -= len(data)
+        self.buffer.clear()
+
+UPLOAD_CHUNK_SIZE = 4194304
+
+class ChunkedUploads:
+    """Unfinished chunked uploads. The state is kept on disk, so uploads can be
+    resumed after a restart and chunks may be received by any process."""
+    min_chunk_size = 65536
+    checksums = ("sha256", "crc32")
+
+    def __init__(self):
+        name = "hass-configurator-uploads"
+        if hasattr(os, "getuid"):
+            name += "-%i" % os.getuid()
+        self.path = os.path.join(tempfile.gettempdir(), name)
+        self.lock = threading.Lock()
+        self.checked = False
+
+    def _directory(self):
+        """Create the state directory, refusing one other users have access to."""
+        if not self.checked:
+            try:
+                os.mkdir(self.path, 0o700)
+            except FileExistsError:
+                pass
+            info = os.lstat(self.path)
+            if not S_ISDIR(info.st_mode) or hasattr(os, "getuid") and (
+                    info.st_uid != os.getuid() or info.st_mode & 0o077):
+                raise ValueError("Upload directory is not private: %s" % self.path)
+            self.checked = True
+        return self.path
+
+    def _session(self, upload_id):
+        if not re.fullmatch(r"[0-9a-f]{32}", upload_id or ""):
+            raise ValueError("Unknown upload")
+        return os.path.join(self._directory(), upload_id)
+
+    def _remove(self, upload_id):
+        try:
+            os.remove(self.get(upload_id)["data"])
+        except (OSError, ValueError):
+            pass
+        shutil.rmtree(self._session(upload_id), ignore_errors=True)
+
+    def expire(self):
+        """Remove uploads which haven't received a chunk within UPLOAD_TTL."""
+        try:
+            entries = list(os.scandir(self._directory()))
+        except FileNotFoundError:
+            return
+        now = time.time()
+        for entry in entries:
+            # Every received chunk adds a file and updates the mtime
+            if entry.is_dir() and now - entry.stat().st_mtime > UPLOAD_TTL:
+                LOG.info("Removing expired upload %s", entry.name)
+                self._remove(entry.name)
+
+    def create(self, directory, filename, size, chunk_size):
+        """Reserve space for an upload and return its manifest."""
+        if size < 0 or chunk_size <= 0:
+            raise ValueError("Invalid size or chunk size")
+        if size > UPLOAD_MAX_SIZE:
+            raise ValueError("File too big: %i" % size)
+        chunk_size = max(self.min_chunk_size, min(chunk_size, UPLOAD_CHUNK_SIZE))
+        with self.lock:
+            self.expire()
+            reserved = 0
+            for entry in os.scandir(self._directory()):
+                try:
+                    reserved += self.get(entry.name)["size"]
+                except (OSError, ValueError):
+                    pass
+            if reserved + size > UPLOAD_QUOTA:
+                raise ValueError("Upload quota exceeded: %i bytes in use" % reserved)
+            if shutil.disk_usage(directory).free < size:
+                raise ValueError("Not enough disk space")
+            upload_id = uuid.uuid4().hex
+            manifest = {
+                "id": upload_id,
+                "destination": os.path.join(directory, filename),
+                "data": os.path.join(directory, ".upload-%s" % upload_id),
+                "size": size,
+                "chunksize": chunk_size,
+                "chunks": -(-size // chunk_size)
+            }
+            os.makedirs(self._session(upload_id))
+            created = False
+            try:
+                with open(manifest["data"], "xb") as fptr:
+                    created = True
+                    fptr.truncate(size)
+                with open(os.path.join(self._session(upload_id), "manifest.json"), "w",
+                          encoding="utf-8") as fptr:
+                    json.dump(manifest, fptr)
+            except Exception:
+                if created:
+                    try:
+                        os.remove(manifest["data"])
+                    except OSError:
+                        pass
+                shutil.rmtree(self._session(upload_id), ignore_errors=True)
+                raise
+        return manifest
+
+    def get(self, upload_id):
+        """Return the manifest of an upload, refusing paths it can't have created."""
+        try:
+            with open(os.path.join(self._session(upload_id), "manifest.json"),
+                      encoding="utf-8") as fptr:
+                manifest = json.load(fptr)
+        except FileNotFoundError:
+            raise ValueError("Unknown upload") from None
+        destination = manifest.get("destination", "")
+        data = os.path.join(os.path.dirname(destination), ".upload-%s" % upload_id)
+        if manifest.get("id") != upload_id or manifest.get("data") != data or \
+                ENFORCE_BASEPATH and not is_safe_path(BASEPATH, destination.encode('utf-8')):
+            raise ValueError("Invalid upload")
+        return manifest
+
+    def received(self, upload_id):
+        """Return the sorted indices of the chunks received so far."""
+        return sorted(int(name) for name in os.listdir(self._session(upload_id))
+                      if name.isdigit())
+
+    @staticmethod
+    def chunk_length(manifest, index):
+        """Return the number of bytes chunk index has to contain."""
+        if not 0 <= index < manifest["chunks"]:
+            raise ValueError("Invalid chunk: %i" % index)
+        return min(manifest["chunksize"], manifest["size"] - index * manifest["chunksize"])
+
+    def write(self, manifest, index, rfile, algorithm, checksum):
+        """Store a chunk read from rfile if it matches the checksum."""
+        remaining = self.chunk_length(manifest, index)
+        digest = hashlib.sha256() if algorithm == "sha256" else None
+        crc = 0
+        with open(manifest["data"], "r+b") as fptr:
+            fptr.seek(index * manifest["chunksize"])
+            while remaining:
+                data = rfile.read(min(self.min_chunk_size, remaining))
+                if not data:
+                    raise ValueError("Incomplete chunk")
+                remaining -= len(data)
+                fptr.write(data)
+                if digest is not None:
+                    digest.update(data)
+                else:
+                    crc = zlib.crc32(data, crc)
+        actual = digest.hexdigest() if digest is not None else "%08x" % crc
+        if actual != checksum.lower():
+            raise ValueError("Checksum mismatch for chunk %i" % index)
+        with open(os.path.join(self._session(manifest["id"]), str(index)), "w",
+                  encoding="utf-8"):
+            pass
+
+    def finish(self, upload_id):
+        """Move a complete upload to its destination."""
+        manifest = self.get(upload_id)
+        missing = manifest["chunks"] - len(self.received(upload_id))
+        if missing:
+            raise ValueError("Missing %i of %i chunks" % (missing, manifest["chunks"]))
+        os.replace(manifest["data"], manifest["destination"])
+        shutil.rmtree(self._session(upload_id), ignore_errors=True)
+        return manifest
+
+    def abort(self, upload_id):
+        """Discard an upload."""
+        self.get(upload_id)
+        self._remove(upload_id)
+
+UPLOADS = ChunkedUploads()
+
+OUTPUT_CHUNK_SIZE = 4096
+FILE_CHUNK_SIZE = 65536
+# Largest window returned by /api/tail, and seconds between checks for new
+# data in follow mode.
+TAIL_MAX_BYTES = 1048576
+TAIL_POLL_INTERVAL = 0.5
+
+class CommandJob: # pylint: disable=too-many-instance-attributes
+    """Shell command run by COMMANDS, keeping its most recent output. If
+    collect is set, up to that many bytes of output are kept in full as well."""
+    def __init__(self, args, command, timeout, collect=0):
+        self.job_id = uuid.uuid4().hex
+        self.args = args
+        self.command = command
+        self.timeout = timeout
+        self.state = "queued"
+        self.message = "Command queued: %s" % command
+        self.returncode = None
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+        self.proc = None
+        self.output = collections.deque()
+        self.size = 0
+        self.seq = 0
+        self.collect = collect
+        self.collected = {'stdout': [], 'stderr': []}
+        self.collected_size = 0
+        self.truncated = False
+        self.condition = threading.Condition()
+        self.listeners = []
+
+    def _notify(self):
+        """Wake up waiting readers, the condition has to be held."""
+        self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def append(self, name, text, size):
+        """Add output, dropping the oldest output beyond EXEC_OUTPUT_BUFFER."""
+        with self.condition:
+            self.seq += 1
+            self.output.append((self.seq, name, text, size))
+            self.size += size
+            while self.size > EXEC_OUTPUT_BUFFER and len(self.output) > 1:
+                self.size -= self.output.popleft()[3]
+            if self.collect:
+                keep = max(0, min(size, self.collect - self.collected_size))
+                if keep < size:
+                    self.truncated = True
+                    text = text.encode('utf-8')[:keep].decode('utf-8', errors='ignore')
+                if text:
+                    self.collected[name].append(text)
+                self.collected_size += keep
+            self._notify()
+
+    async def forward(self, stream, name):
+        """Read the output of the process from stream."""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            chunk = await stream.read(OUTPUT_CHUNK_SIZE)
+            if not chunk:
+                break
+            text = decoder.decode(chunk)
+            if text:
+                self.append(name, text, len(chunk))
+        text = decoder.decode(b"", final=True)
+        if text:
+            self.append(name, text, 0)
+
+    def finish(self, state, message):
+        """Mark the job as finished and wake up waiting readers."""
+        with self.condition:
+            self.state = state
+            self.message = message
+            self.finished = time.time()
+            self._notify()
+
+    def read(self, since, timeout=None):
+        """Get the output after sequence number since, waiting up to timeout
+        for more. Also returns if the job had finished."""
+        with self.condition:
+            if self.seq <= since and self.finished is None:
+                self.condition.wait(timeout)
+            return [chunk[:3] for chunk in self.output if chunk[0] > since], \
+                self.finished is not None
+
+    async def wait_async(self, predicate, timeout=None):
+        """Wait without blocking the event loop until predicate, which is
+        called with the condition held, is true or timeout has passed."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        event = asyncio.Event()
+        def listener():
+            loop.call_soon_threadsafe(event.set)
+        with self.condition:
+            self.listeners.append(listener)
+        try:
+            while True:
+                with self.condition:
+                    if predicate():
+                        return True
+                    event.clear()
+                remaining = None if deadline is None else deadline - loop.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.condition:
+                self.listeners.remove(listener)
+
+    async def read_async(self, since, timeout=None):
+        """Like read, but waits without blocking the event loop."""
+        await self.wait_async(lambda: self.seq > since or self.finished is not None, timeout)
+        return self.read(since, 0)
+
+    def as_dict(self):
+        """Get the state of the job for the API."""
+        return {
+            "job": self.job_id,
+            "command": self.command,
+            "state": self.state,
+            "message": self.message,
+            "returncode": self.returncode,
+            "started": self.started,
+            "finished": self.finished
+        }
+
+class CommandRunner:
+    """Run shell commands in the background, MAX_COMMANDS at a time. The
+    processes are managed by an event loop in a thread of its own."""
+    def __init__(self, history=20):
+        self.history = history
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.loop = None
+        self.slots = None
+
+    def _start_loop(self):
+        """Start the event loop managing the processes, the lock has to be held."""
+        self.loop = asyncio.new_event_loop()
+        self.slots = asyncio.Semaphore(MAX_COMMANDS)
+        threading.Thread(target=self.loop.run_forever, name="commands", daemon=True).start()
+
+    def start(self, args, command, timeout, collect=0):
+        """Queue a command and return its job."""
+        job = CommandJob(args, command, timeout, collect)
+        with self.lock:
+            if self.loop is None:
+                self._start_loop()
+            finished = [old for old in self.jobs.values() if old.finished]
+            for old in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[old.job_id]
+            self.jobs[job.job_id] = job
+        asyncio.run_coroutine_threadsafe(self._run(job), self.loop)
+        return job
+
+    async def _run(self, job):
+        """Run the command of a job once a slot is free."""
+        async with self.slots:
+            with job.condition:
+                if job.cancelled:
+                    job.finish("cancelled", "Command cancelled: %s" % job.command)
+                    return
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *job.args,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE)
+            except Exception as err:
+                LOG.warning(err)
+                job.finish("failed", str(err))
+                return
+            with job.condition:
+                job.proc = proc
+                job.state = "running"
+                job.message = "Command running: %s" % job.command
+                job.started = time.time()
+                if job.cancelled:
+                    proc.kill()
+            readers = [asyncio.ensure_future(job.forward(proc.stdout, 'stdout')),
+                       asyncio.ensure_future(job.forward(proc.stderr, 'stderr'))]
+            state = "finished"
+            message = "Command executed: %s" % job.command
+            try:
+                job.returncode = await asyncio.wait_for(proc.wait(), job.timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                job.returncode = await proc.wait()
+                state = "timeout"
+                message = "Command timed out after %i seconds: %s" % (job.timeout, job.command)
+            # Processes started by the command may keep the pipes open
+            _, pending = await asyncio.wait(readers, timeout=1)
+            for reader in pending:
+                reader.cancel()
+            if job.cancelled:
+                state = "cancelled"
+                message = "Command cancelled: %s" % job.command
+            job.finish(state, message)
+
+    def get(self, job_id):
+        """Get a job by its id."""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        """Get all known jobs, oldest first."""
+        with self.lock:
+            return list(self.jobs.values())
+
+    @staticmethod
+    def _signal(job, kill):
+        """Stop the process of a job, called on the event loop."""
+        if job.proc is not None and job.proc.returncode is None:
+            if kill:
+                job.proc.kill()
+            else:
+                job.proc.terminate()
+
+    def cancel(self, job, kill=False):
+        """Stop a queued or running job."""
+        with job.condition:
+            job.cancelled = True
+        self.loop.call_soon_threadsafe(self._signal, job, kill)
+
+    async def _kill(self, jobs):
+        for job in jobs:
+            self._signal(job, True)
+
+    def close(self):
+        """Kill all running commands."""
+        if self.loop is None:
+            return
+        jobs = [job for job in self.list() if job.finished is None]
+        for job in jobs:
+            with job.condition:
+                job.cancelled = True
+        try:
+            asyncio.run_coroutine_threadsafe(self._kill(jobs), self.loop).result(1)
+        except concurrent.futures.TimeoutError:
+            LOG.warning("Unable to stop running commands")
+
+COMMANDS = CommandRunner()
+COMMANDS_SINGLE_PROCESS = "Running commands can only be managed with PROCESSES = 1"
+
+# pylint: disable=too-many-public-methods
 class RequestHandler(BaseHTTPRequestHandler):
     """Request handler."""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    response_status = None
+    socket_wfile = None
+    content_length_sent = False
+    chunked = False
+    deferred = None
+    output = None
+
     # pylint: disable=redefined-builtin
     def log_message(self, format, *args):
         LOG.info("%s - %s", self.client_address[0], format % args)
 
-    # pylint: disable=invalid-name
-    def do_BLOCK(self, status=420, reason="Policy not fulfilled"):
-        """Customized do_BLOCK method."""
-        self.send_response(status)
-        self.end_headers()
-        self.wfile.write(bytes(reason, "utf8"))
+    def handle_one_request(self):
+        """Handle a request, buffering the response if it has no Content-Length."""
+        self.connection.settimeout(CONNECTION_IDLE_TIMEOUT)
+        self.response_status = None
+        self.content_length_sent = False
+        self.chunked = False
+        super().handle_one_request()
+        if self.socket_wfile is not None:
+            body = self.wfile.getvalue()
+            self.wfile = self.socket_wfile
+            self.socket_wfile = None
+            super().send_header('Content-Length', str(len(body)))
+            super().end_headers()
+            self.wfile.write(body)
+        if not self.close_connection:
+            busy = getattr(self.server, 'busy', None)
+            if busy is not None and busy():
+                # Free the worker for waiting connections instead of idling
+                self.close_connection = True
 
-    # pylint: disable=invalid-name
-    def do_GET(self):
-        """Customized do_GET method."""
-        if not verify_hostname(self.headers.get('Host', '')):
-            self.do_BLOCK(403, "Forbidden")
+    def parse_request(self):
+        self.connection.settimeout(CONNECTION_READ_TIMEOUT)
+        SHARED_STATE.pull()
+        return super().parse_request()
+
+    def send_response_only(self, code, message=None):
+        self.response_status = code
+        super().send_response_only(code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self.content_length_sent = True
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        if not self.content_length_sent and self.response_status is not None and \
+                self.response_status >= 200 and self.response_status not in (204, 304):
+            # Collect the body to send it with an exact Content-Length
+            self.socket_wfile = self.wfile
+            self.wfile = io.BytesIO()
+            return
+        super().end_headers()
+
+    def start_stream(self, content_type):
+        """Send the headers of a response whose body is sent with write_chunk."""
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Cache-Control', 'no-cache')
+        if self.request_version != 'HTTP/1.0':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.chunked = True
+        else:
+            self.send_header('Connection', 'close')
+        # The body is delimited by the chunks or by closing the connection
+        self.content_length_sent = True
+        self.end_headers()
+
+    def write_chunk(self, data):
+        """Send a part of a streamed response body."""
+        if not data:
+            return
+        if self.chunked:
+            data = b"%X\r\n%s\r\n" % (len(data), data)
+        self.wfile.write(data)
+
+    def end_stream(self):
+        """Finish a streamed response."""
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def run_async(self, coroutine):
+        """Finish the request with a coroutine, which writes to wfile and sends
+        the output with flush_async. With the asyncio engine it's run on the
+        event loop once the handler thread has been released, otherwise it's
+        run in the handler thread."""
+        if isinstance(self.wfile, AsyncWriter):
+            self.deferred = self._run_deferred(coroutine)
+        else:
+            asyncio.run(self._run_deferred(coroutine))
+
+    def run_stream(self, coroutine):
+        """Like run_async, for responses streamed until the client goes away.
+        With the threads engine these keep a worker busy, so they are limited
+        to the stream slots of the server."""
+        slots = getattr(self.server, 'streams', None)
+        if isinstance(self.wfile, AsyncWriter) or slots is None:
+            self.run_async(coroutine)
+            return
+        if not slots.acquire(blocking=False):
+            coroutine.close()
+            LOG.warning("Rejecting stream to %s: all stream slots busy", self.client_address[0])
+            self.write_json({"error": True, "message": "Too many open streams"}, 503)
+            return
+        try:
+            self.run_async(coroutine)
+        finally:
+            slots.release()
+
+    async def _run_deferred(self, coroutine):
+        self.output, self.wfile = self.wfile, io.BytesIO()
+        try:
+            await coroutine
+            await self.flush_async()
+        except OSError as err:
+            LOG.warning(err)
+            self.close_connection = True
+        finally:
+            self.wfile = self.output
+            self.deferred = None
+
+    async def flush_async(self):
+        """Send what a coroutine run by run_async has written to wfile."""
+        data = self.wfile.getvalue()
+        self.wfile.seek(0)
+        self.wfile.truncate()
+        if not data:
+            return
+        if isinstance(self.output, AsyncWriter):
+            await self.output.write_async(data)
+        else:
+            self.output.write(data)
+
+    def write_json(self, data, status=200):
+        """Send a JSON response with a known length."""
+        body = bytes(json.dumps(data), "utf8")
+        self.send_response(status)
+        self.send_header('Content-type', 'text/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_event(self, event, data, event_id=None):
+        """Send a server-sent event with JSON encoded data."""
+        event_id = "" if event_id is None else "id: %i\n" % event_id
+        self.write_chunk(bytes("event: %s\n%sdata: %s\n\n" % (
+            event, event_id, json.dumps(data)), "utf8"))
+
+    def send_file(self, fptr, content_type=None, headers=()):
+        """Send an open file as the response without reading it into memory.
+        Range requests are answered with the requested parts of the file."""
+        stat = os.fstat(fptr.fileno())
+        size = stat.st_size
+        etag = '"%x-%x"' % (stat.st_mtime_ns, size)
+        modified = int(stat.st_mtime)
+        if is_not_modified(self.headers, etag, modified):
+            self.send_not_modified(etag, CACHE_CONTROL_REVALIDATE)
+            return
+        ranges = None
+        if self.headers.get('Range') and if_range_matches(self.headers, etag, modified):
+            ranges = parse_range(self.headers['Range'], size)
+        if ranges == []:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%i' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        try:
+            self.send_response(206 if ranges else 200)
+            for keyword, value in headers:
+                self.send_header(keyword, value)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(modified))
+            self.send_header('Cache-Control', CACHE_CONTROL_REVALIDATE)
+            self.send_header('Accept-Ranges', 'bytes')
+            if ranges is None or len(ranges) == 1:
+                start, end = ranges[0] if ranges else (0, size - 1)
+                if content_type is not None:
+                    self.send_header('Content-type', content_type)
+                if ranges:
+                    self.send_header('Content-Range', 'bytes %i-%i/%i' % (start, end, size))
+                self.send_header('Content-Length', str(end - start + 1))
+                self.end_headers()
+                self.copy_file(fptr, start, end - start + 1)
+                return
+            boundary = uuid.uuid4().hex
+            parts = []
+            for start, end in ranges:
+                parts.append((start, end, bytes(
+                    "--%s\r\nContent-type: %s\r\nContent-Range: bytes %i-%i/%i\r\n\r\n" % (
+                        boundary, content_type or 'application/octet-stream',
+                        start, end, size), "latin-1")))
+            closing = bytes("--%s--\r\n" % boundary, "latin-1")
+            length = len(closing) + sum(len(head) + end - start + 3 for start, end, head in parts)
+            self.send_header('Content-type', 'multipart/byteranges; boundary=%s' % boundary)
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            for start, end, head in parts:
+                self.wfile.write(head)
+                if not self.copy_file(fptr, start, end - start + 1):
+                    return
+                self.wfile.write(b"\r\n")
+            self.wfile.write(closing)
+        except Exception as err:
+            # Part of the response may have been sent already, don't add another
+            LOG.warning(err)
+            self.close_connection = True
+
+    def copy_file(self, fptr, offset, count):
+        """Send count bytes of fptr starting at offset to the client."""
+        if not count:
+            return True
+        sent = 0
+        try:
+            if isinstance(self.connection, socket.socket) and \
+                    not isinstance(self.connection, ssl.SSLSocket):
+                # Let the kernel copy the file to the socket
+                sent = self.connection.sendfile(fptr, offset, count)
+            else:
+                fptr.seek(offset)
+                buffer = memoryview(bytearray(min(count, FILE_CHUNK_SIZE) or 1))
+                while sent < count:
+                    read = fptr.readinto(buffer[:count - sent])
+                    if not read:
+                        break
+                    self.wfile.write(buffer[:read])
+                    sent += read
+        except OSError as err:
+            LOG.warning(err)
+        if sent < count:
+            # The body doesn't match the Content-Length
+            self.close_connection = True
+            return False
+        return True
+
+    # pylint: disable=invalid-name
+    def do_BLOCK(self, status=420, reason="Policy not fulfilled"):
+        """Customized do_BLOCK method."""
+        self.close_connection = True
+        self.send_response(status)
+        self.end_headers()
+        self.wfile.write(bytes(reason, "utf8"))
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """Customized do_GET method."""
+        if not verify_hostname(self.headers.get('Host', '')):
+            self.do_BLOCK(403, "Forbidden")
             return
         req = urlparse(self.path)
         if SESAME or TOTP:
             chunk = req.path.split("/")[-1]
             if SESAME and chunk == SESAME:
-                if self.client_address[0] not in ALLOWED_NETWORKS:
-                    ALLOWED_NETWORKS.append(self.client_address[0])
-                if self.client_address[0] in BANNED_IPS:
-                    BANNED_IPS.remove(self.client_address[0])
+                with SHARED_STATE:
+                    if self.client_address[0] not in ALLOWED_NETWORKS:
+                        ALLOWED_NETWORKS.append(self.client_address[0])
+                    if self.client_address[0] in BANNED_IPS:
+                        BANNED_IPS.remove(self.client_address[0])
                 url = req.path[:req.path.rfind(chunk)]
                 self.send_response(302)
                 self.send_header('Location', url)
@@ -484,10 +2489,11 @@ class RequestHandler(BaseHTTPRequestHandler):
                 notify(**data)
                 return
             if TOTP and TOTP.verify(chunk):
-                if self.client_address[0] not in ALLOWED_NETWORKS:
-                    ALLOWED_NETWORKS.append(self.client_address[0])
-                if self.client_address[0] in BANNED_IPS:
-                    BANNED_IPS.remove(self.client_address[0])
+                with SHARED_STATE:
+                    if self.client_address[0] not in ALLOWED_NETWORKS:
+                        ALLOWED_NETWORKS.append(self.client_address[0])
+                    if self.client_address[0] in BANNED_IPS:
+                        BANNED_IPS.remove(self.client_address[0])
                 url = req.path[:req.path.rfind(chunk)]
                 self.send_response(302)
                 self.send_header('Location', url)
@@ -503,450 +2509,17 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.do_BLOCK()
             return
         query = parse_qs(req.query)
-        self.send_response(200)
-        # pylint: disable=no-else-return
-        if req.path.endswith('/api/file'):
-            content = ""
-            filename = query.get('filename', None)
-            try:
-                if filename:
-                    is_raw = False
-                    filename = unquote(filename[0]).encode('utf-8')
-                    if ENFORCE_BASEPATH and not is_safe_path(BASEPATH, filename):
-                        raise OSError('Access denied.')
-                    filepath = os.path.join(BASEDIR.encode('utf-8'), filename)
-                    if os.path.isfile(filepath):
-                        mimetype = mimetypes.guess_type(filepath.decode('utf-8'))
-                        if mimetype[0] is not None:
-                            if mimetype[0].split('/')[0] == 'image':
-                                is_raw = True
-                        if is_raw:
-                            content = load_file(filepath)
-                            self.send_header('Content-type', mimetype[0])
-                        else:
-                            content = load_file(filepath).decode("utf-8")
-                            self.send_header('Content-type', 'text/text')
-                    else:
-                        self.send_header('Content-type', 'text/text')
-                        content = "File not found"
-            except Exception as err:
-                LOG.warning(err)
-                self.send_header('Content-type', 'text/text')
-                content = str(err)
-            self.end_headers()
-            if is_raw:
-                self.wfile.write(content)
-            else:
-                self.wfile.write(bytes(content, "utf8"))
-            return
-        elif req.path.endswith('/api/download'):
-            content = ""
-            filename = query.get('filename', None)
-            try:
-                if filename:
-                    filename = unquote(filename[0]).encode('utf-8')
-                    if ENFORCE_BASEPATH and not is_safe_path(BASEPATH, filename):
-                        raise OSError('Access denied.')
-                    LOG.info(filename)
-                    filepath = os.path.join(BASEDIR.encode('utf-8'), filename)
-                    if os.path.isfile(filepath):
-                        filecontent = load_file(filepath)
-                        self.send_header(
-                            'Content-Disposition',
-                            'attachment; filename=%s' % filename.decode('utf-8').split(os.sep)[-1])
-                        self.end_headers()
-                        self.wfile.write(filecontent)
-                        return
-                    content = "File not found"
-            except Exception as err:
-                LOG.warning(err)
-                content = str(err)
-            self.send_header('Content-type', 'text/text')
-            self.wfile.write(bytes(content, "utf8"))
-            return
-        elif req.path.endswith('/api/listdir'):
-            content = {'error': None}
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            dirpath = query.get('path', None)
-            try:
-                if dirpath:
-                    dirpath = unquote(dirpath[0]).encode('utf-8')
-                    if os.path.isdir(dirpath):
-                        if ENFORCE_BASEPATH and not is_safe_path(BASEPATH,
-                                                                 dirpath):
-                            raise OSError('Access denied.')
-                        repo = None
-                        activebranch = None
-                        dirty = False
-                        branches = []
-                        if REPO:
-                            try:
-                                # pylint: disable=not-callable
-                                repo = REPO(dirpath.decode('utf-8'),
-                                            search_parent_directories=True)
-                                activebranch = repo.active_branch.name
-                                dirty = repo.is_dirty()
-                                for branch in repo.branches:
-                                    branches.append(branch.name)
-                            except Exception as err:
-                                LOG.debug("Exception (no repo): %s", str(err))
-                        dircontent = get_dircontent(dirpath.decode('utf-8'), repo)
-                        filedata = {
-                            'content': dircontent,
-                            'abspath': os.path.abspath(dirpath).decode('utf-8'),
-                            'parent': os.path.dirname(os.path.abspath(dirpath)).decode('utf-8'),
-                            'branches': branches,
-                            'activebranch': activebranch,
-                            'dirty': dirty,
-                            'error': None
-                        }
-                        self.wfile.write(bytes(json.dumps(filedata), "utf8"))
-            except Exception as err:
-                LOG.warning(err)
-                content['error'] = str(err)
-                self.wfile.write(bytes(json.dumps(content), "utf8"))
-            return
-        elif req.path.endswith('/api/abspath'):
-            content = ""
-            self.send_header('Content-type', 'text/text')
-            self.end_headers()
-            dirpath = query.get('path', None)
-            if dirpath:
-                dirpath = unquote(dirpath[0]).encode('utf-8')
-                LOG.debug(dirpath)
-                absp = os.path.abspath(dirpath)
-                LOG.debug(absp)
-                if os.path.isdir(dirpath):
-                    self.wfile.write(os.path.abspath(dirpath))
-            return
-        elif req.path.endswith('/api/parent'):
-            content = ""
-            self.send_header('Content-type', 'text/text')
-            self.end_headers()
-            dirpath = query.get('path', None)
-            if dirpath:
-                dirpath = unquote(dirpath[0]).encode('utf-8')
-                LOG.debug(dirpath)
-                absp = os.path.abspath(dirpath)
-                LOG.debug(absp)
-                if os.path.isdir(dirpath):
-                    self.wfile.write(os.path.abspath(os.path.dirname(dirpath)))
-            return
-        elif req.path.endswith('/api/netstat'):
-            content = ""
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            res = {
-                "allowed_networks": ALLOWED_NETWORKS,
-                "banned_ips": BANNED_IPS
-            }
-            self.wfile.write(bytes(json.dumps(res), "utf8"))
-            return
-        elif req.path.endswith('/api/restart'):
-            LOG.info("/api/restart")
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            res = {"restart": False}
-            try:
-                headers = {
-                    "Content-Type": "application/json"
-                }
-                if HASS_API_PASSWORD:
-                    if is_jwt(HASS_API_PASSWORD):
-                        headers["Authorization"] = "Bearer %s" % HASS_API_PASSWORD
-                    else:
-                        headers["x-ha-access"] = HASS_API_PASSWORD
-                req = urllib.request.Request(
-                    "%sservices/homeassistant/restart" % HASS_API,
-                    headers=headers, method='POST')
-                with urllib.request.urlopen(req) as response:
-                    res = json.loads(response.read().decode('utf-8'))
-                    LOG.debug(res)
-            except Exception as err:
-                LOG.warning(err)
-                res['restart'] = str(err)
-            self.wfile.write(bytes(json.dumps(res), "utf8"))
-            return
-        elif req.path.endswith('/api/check_config'):
-            LOG.info("/api/check_config")
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            res = {"check_config": False}
-            try:
-                headers = {
-                    "Content-Type": "application/json"
-                }
-                if HASS_API_PASSWORD:
-                    if is_jwt(HASS_API_PASSWORD):
-                        headers["Authorization"] = "Bearer %s" % HASS_API_PASSWORD
-                    else:
-                        headers["x-ha-access"] = HASS_API_PASSWORD
-                req = urllib.request.Request(
-                    "%sservices/homeassistant/check_config" % HASS_API,
-                    headers=headers, method='POST')
-            except Exception as err:
-                LOG.warning(err)
-                res['restart'] = str(err)
-            self.wfile.write(bytes(json.dumps(res), "utf8"))
-            return
-        elif req.path.endswith('/api/reload_automations'):
-            LOG.info("/api/reload_automations")
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            res = {"reload_automations": False}
-            try:
-                headers = {
-                    "Content-Type": "application/json"
-                }
-                if HASS_API_PASSWORD:
-                    if is_jwt(HASS_API_PASSWORD):
-                        headers["Authorization"] = "Bearer %s" % HASS_API_PASSWORD
-                    else:
-                        headers["x-ha-access"] = HASS_API_PASSWORD
-                req = urllib.request.Request(
-                    "%sservices/automation/reload" % HASS_API,
-                    headers=headers, method='POST')
-                with urllib.request.urlopen(req) as response:
-                    LOG.debug(json.loads(response.read().decode('utf-8')))
-                    res['service'] = "called successfully"
-            except Exception as err:
-                LOG.warning(err)
-                res['restart'] = str(err)
-            self.wfile.write(bytes(json.dumps(res), "utf8"))
-            return
-        elif req.path.endswith('/api/reload_scripts'):
-            LOG.info("/api/reload_scripts")
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            res = {"reload_scripts": False}
-            try:
-                headers = {
-                    "Content-Type": "application/json"
-                }
-                if HASS_API_PASSWORD:
-                    if is_jwt(HASS_API_PASSWORD):
-                        headers["Authorization"] = "Bearer %s" % HASS_API_PASSWORD
-                    else:
-                        headers["x-ha-access"] = HASS_API_PASSWORD
-                req = urllib.request.Request(
-                    "%sservices/script/reload" % HASS_API,
-                    headers=headers, method='POST')
-                with urllib.request.urlopen(req) as response:
-                    LOG.debug(json.loads(response.read().decode('utf-8')))
-                    res['service'] = "called successfully"
-            except Exception as err:
-                LOG.warning(err)
-                res['restart'] = str(err)
-            self.wfile.write(bytes(json.dumps(res), "utf8"))
-            return
-        elif req.path.endswith('/api/reload_groups'):
-            LOG.info("/api/reload_groups")
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            res = {"reload_groups": False}
-            try:
-                headers = {
-                    "Content-Type": "application/json"
-                }
-                if HASS_API_PASSWORD:
-                    if is_jwt(HASS_API_PASSWORD):
-                        headers["Authorization"] = "Bearer %s" % HASS_API_PASSWORD
-                    else:
-                        headers["x-ha-access"] = HASS_API_PASSWORD
-                req = urllib.request.Request(
-                    "%sservices/group/reload" % HASS_API,
-                    headers=headers, method='POST')
-                with urllib.request.urlopen(req) as response:
-                    LOG.debug(json.loads(response.read().decode('utf-8')))
-                    res['service'] = "called successfully"
-            except Exception as err:
-                LOG.warning(err)
-                res['restart'] = str(err)
-            self.wfile.write(bytes(json.dumps(res), "utf8"))
-            return
-        elif req.path.endswith('/api/reload_core'):
-            LOG.info("/api/reload_core")
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            res = {"reload_core": False}
-            try:
-                headers = {
-                    "Content-Type": "application/json"
-                }
-                if HASS_API_PASSWORD:
-                    if is_jwt(HASS_API_PASSWORD):
-                        headers["Authorization"] = "Bearer %s" % HASS_API_PASSWORD
-                    else:
-                        headers["x-ha-access"] = HASS_API_PASSWORD
-                req = urllib.request.Request(
-                    "%sservices/homeassistant/reload_core_config" % HASS_API,
-                    headers=headers, method='POST')
-                with urllib.request.urlopen(req) as response:
-                    LOG.debug(json.loads(response.read().decode('utf-8')))
-                    res['service'] = "called successfully"
-            except Exception as err:
-                LOG.warning(err)
-                res['restart'] = str(err)
-            self.wfile.write(bytes(json.dumps(res), "utf8"))
-            return
-        elif req.path.endswith('/'):
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-
-            loadfile = query.get('loadfile', [None])[0]
-            if loadfile is None:
-                loadfile = 'null'
-            else:
-                loadfile = "'%s'" % loadfile
-            services = "[]"
-            events = "[]"
-            states = "[]"
-            try:
-                if HASS_API:
-                    headers = {
-                        "Content-Type": "application/json"
-                    }
-                    if HASS_API_PASSWORD:
-                        if is_jwt(HASS_API_PASSWORD):
-                            headers["Authorization"] = "Bearer %s" % HASS_API_PASSWORD
-                        else:
-                            headers["x-ha-access"] = HASS_API_PASSWORD
-
-                    req = urllib.request.Request("%sservices" % HASS_API,
-                                                 headers=headers, method='GET')
-                    with urllib.request.urlopen(req) as response:
-                        services = response.read().decode('utf-8')
-
-                    req = urllib.request.Request("%sevents" % HASS_API,
-                                                 headers=headers, method='GET')
-                    with urllib.request.urlopen(req) as response:
-                        events = response.read().decode('utf-8')
-
-                    req = urllib.request.Request("%sstates" % HASS_API,
-                                                 headers=headers, method='GET')
-                    with urllib.request.urlopen(req) as response:
-                        states_clean = []
-                        for state in json.loads(response.read().decode('utf-8')):
-                            states_clean.append(
-                                {
-                                    "entity_id": state.get("entity_id", ""),
-                                    "attributes":
-                                    {"friendly_name": state.get("attributes", {}).get(
-                                        "friendly_name", state.get("entity_id", ""))}
-                                }
-                            )
-                        states = json.dumps(states_clean)
-
-            except Exception as err:
-                LOG.warning("Exception getting bootstrap")
-                LOG.warning(err)
-
-            color = ""
-            ws_api = ""
-            if HASS_API:
-                protocol, uri = HASS_API.split("//")
-                ws_api = "%s://%swebsocket" % (
-                    "wss" if protocol == 'https' else 'ws', uri
-                )
-            if HASS_WS_API:
-                ws_api = HASS_WS_API
-            standalone = ""
-            if not HASS_API:
-                standalone = "toggle_hass_panels();"
-            try:
-                html = Template(load_file("dev.html", static=True).decode('utf-8'))
-                html = html.safe_substitute(
-                    services=services,
-                    events=events,
-                    states=states,
-                    loadfile=loadfile,
-                    current=VERSION,
-                    versionclass=color,
-                    githidden="" if GIT else "hiddendiv",
-                    # pylint: disable=anomalous-backslash-in-string
-                    separator="\%s" % os.sep if os.sep == "\\" else os.sep,
-                    your_address=self.client_address[0],
-                    listening_address="%s://%s:%i" % (
-                        'https' if SSL_CERTIFICATE else 'http', LISTENIP, PORT),
-                    hass_api_address="%s" % (HASS_API, ),
-                    hass_ws_address=ws_api,
-                    api_password=HASS_API_PASSWORD if HASS_API_PASSWORD else "",
-                    standalone=standalone)
-            except Exception as err:
-                LOG.warning("Error getting html: %s", err)
-                html = ERROR_HTML
-            self.wfile.write(bytes(html, "utf8"))
-            return
-        elif req.path.endswith('/jquery-3.6.0.min.js'):
-            try:
-                data = load_file("jquery-3.6.0.min.js", static=True)
-            except Exception as err:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(bytes("File not found", "utf8"))
-            self.send_header('Content-type', 'application/javascript')
-            self.end_headers()
-            self.wfile.write(data)
-        elif req.path.endswith('/flUhRq6tzZclQEJ-Vdg-IuiaDsNc.woff2'):
-            try:
-                data = load_file("flUhRq6tzZclQEJ-Vdg-IuiaDsNc.woff2", static=True)
-            except Exception as err:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(bytes("File not found", "utf8"))
-            self.send_header('Content-type', 'font/woff')
-            self.end_headers()
-            self.wfile.write(data)
-        elif req.path.endswith('/js-yaml.min.js'):
-            try:
-                data = load_file("js-yaml.min.js", static=True)
-            except Exception as err:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(bytes("File not found", "utf8"))
-            self.send_header('Content-type', 'application/javascript')
-            self.end_headers()
-            self.wfile.write(data)
-        elif req.path.endswith('/materialize.min.js'):
-            try:
-                data = load_file("materialize.min.js", static=True)
-            except Exception as err:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(bytes("File not found", "utf8"))
-            self.send_header('Content-type', 'application/javascript')
-            self.end_headers()
-            self.wfile.write(data)
-        elif req.path.endswith('/material-icons.fallback.css'):
-            try:
-                data = load_file("material-icons.fallback.css", static=True)
-            except Exception as err:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(bytes("File not found", "utf8"))
-            self.send_header('Content-type', 'text/css')
-            self.end_headers()
-            self.wfile.write(data)
-        elif req.path.endswith('/style.css'):
-            try:
-                data = load_file("style.css", static=True)
-            except Exception as err:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(bytes("File not found", "utf8"))
-            self.send_header('Content-type', 'text/css')
-            self.end_headers()
-            self.wfile.write(data)
-        else:
+        handler = ROUTER.resolve('GET', req.path)
+        if handler is None:
             self.send_response(404)
             self.end_headers()
             self.wfile.write(bytes("File not found", "utf8"))
+            return
+        getattr(self, handler)(req, query)
 
     # pylint: disable=invalid-name
     def do_POST(self):
         """Customized do_POST method."""
-        global ALLOWED_NETWORKS, BANNED_IPS
         if not verify_hostname(self.headers.get('Host', '')):
             self.do_BLOCK(403, "Forbidden")
             return
@@ -961,621 +2534,1389 @@ class RequestHandler(BaseHTTPRequestHandler):
         }
 
         length = int(self.headers['content-length'])
-        if req.path.endswith('/api/save'):
+        handler = ROUTER.resolve('POST', req.path)
+        if handler is None:
+            self.rfile.read(length)
+            response['message'] = "Invalid method"
+        else:
             try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'filename' in postvars.keys() and 'text' in postvars.keys():
-                if postvars['filename'] and postvars['text']:
-                    try:
-                        filename = unquote(postvars['filename'][0])
-                        response['file'] = filename
-                        with open(filename, 'wb') as fptr:
-                            fptr.write(bytes(postvars['text'][0], "utf-8"))
-                        self.send_response(200)
-                        self.send_header('Content-type', 'text/json')
-                        self.end_headers()
-                        response['error'] = False
-                        response['message'] = "File saved successfully"
-                        self.wfile.write(bytes(json.dumps(response), "utf8"))
-                        return
-                    except Exception as err:
-                        response['message'] = "%s" % (str(err))
-                        LOG.warning(err)
-            else:
-                response['message'] = "Missing filename or text"
-        elif req.path.endswith('/api/upload'):
-            if length > 104857600: #100 MB for now
-                read = 0
-                while read < length:
-                    read += len(self.rfile.read(min(66556, length - read)))
-                self.send_response(200)
-                self.send_header('Content-type', 'text/json')
+                if getattr(self, handler)(req, length, response):
+                    return
+            finally:
+                # Files or the repository may have been changed
+                GIT_STATUS_CACHE.clear()
+        self.send_response(200)
+        if self.close_connection:
+            # The request body hasn't been read
+            self.send_header('Connection', 'close')
+        self.send_header('Content-type', 'text/json')
+        self.end_headers()
+        self.wfile.write(bytes(json.dumps(response), "utf8"))
+
+    # pylint: disable=invalid-name
+    def do_PUT(self):
+        """Customized do_PUT method."""
+        if not verify_hostname(self.headers.get('Host', '')):
+            self.do_BLOCK(403, "Forbidden")
+            return
+        if not check_access(self.client_address[0]):
+            self.do_BLOCK()
+            return
+        req = urlparse(self.path)
+
+        response = {
+            "error": True,
+            "message": "Generic failure"
+        }
+
+        length = int(self.headers.get('content-length', 0))
+        handler = ROUTER.resolve('PUT', req.path)
+        if handler is None:
+            self.close_connection = True
+            response['message'] = "Invalid method"
+        elif getattr(self, handler)(req, length, response):
+            return
+        self.send_response(200)
+        if self.close_connection:
+            # The request body hasn't been read
+            self.send_header('Connection', 'close')
+        self.send_header('Content-type', 'text/json')
+        self.end_headers()
+        self.wfile.write(bytes(json.dumps(response), "utf8"))
+
+    def serve_static(self, req, query):
+        """Handle GET for files shipped with the configurator."""
+        filename = req.path.split('/')[-1]
+        cached = STATIC_CACHE.get(filename)
+        if cached is None:
+            data = load_file(filename, static=True)
+            if data is None:
+                self.send_response(404)
                 self.end_headers()
-                response['error'] = True
-                response['message'] = "File too big: %i" % read
-                self.wfile.write(bytes(json.dumps(response), "utf8"))
+                self.wfile.write(bytes("File not found", "utf8"))
                 return
-            form = cgi.FieldStorage(
-                fp=self.rfile,
-                headers=self.headers,
-                environ={
-                    'REQUEST_METHOD': 'POST',
-                    'CONTENT_TYPE': self.headers['Content-Type'],
-                })
-            filename = form['file'].filename
-            filepath = form['path'].file.read()
-            data = form['file'].file.read()
-            open("%s%s%s" % (filepath, os.sep, filename), "wb").write(data)
-            self.send_response(200)
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            response['error'] = False
-            response['message'] = "Upload successful"
-            self.wfile.write(bytes(json.dumps(response), "utf8"))
+            cached = static_entry(filename, data)
+        cache_control = CACHE_CONTROL_REVALIDATE
+        if filename in STATIC_IMMUTABLE and not DEV:
+            cache_control = CACHE_CONTROL_IMMUTABLE
+        variants = cached["variants"]
+        if is_not_modified(self.headers, cached["etag"], cached["modified"]):
+            self.send_not_modified(cached["etag"], cache_control,
+                                   vary=len(variants) > 1)
             return
-        elif req.path.endswith('/api/rename'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'src' in postvars.keys() and 'dstfilename' in postvars.keys():
-                if postvars['src'] and postvars['dstfilename']:
-                    try:
-                        src = unquote(postvars['src'][0])
-                        dstfilename = unquote(postvars['dstfilename'][0])
-                        renamepath = src[:src.index(os.path.basename(src))] + dstfilename
-                        response['path'] = renamepath
-                        try:
-                            os.rename(src, renamepath)
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            response['error'] = False
-                            response['message'] = "Rename successful"
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
+        encoding = "identity"
+        accepted = accepted_encodings(self.headers.get('Accept-Encoding'))
+        for candidate in ("br", "gzip"):
+            if candidate in variants and (candidate in accepted or "*" in accepted):
+                encoding = candidate
+                break
+        data = variants[encoding]
+        self.send_response(200)
+        self.send_header('Content-type', cached["mimetype"])
+        if encoding != "identity":
+            self.send_header('Content-Encoding', encoding)
+        if len(variants) > 1:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', cached["etag"])
+        if cached["modified"] is not None:
+            self.send_header('Last-Modified', self.date_time_string(cached["modified"]))
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_not_modified(self, etag, cache_control, vary=False):
+        """Answer a conditional request with 304 Not Modified."""
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        if vary:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+
+    def api_file(self, req, query):
+        """Handle GET /api/file."""
+        content = ""
+        raw = None
+        filename = query.get('filename', None)
+        try:
+            if filename:
+                filename = unquote(filename[0]).encode('utf-8')
+                if ENFORCE_BASEPATH and not is_safe_path(BASEPATH, filename):
+                    raise OSError('Access denied.')
+                filepath = os.path.join(BASEDIR.encode('utf-8'), filename)
+                if os.path.isfile(filepath):
+                    mimetype = mimetypes.guess_type(filepath.decode('utf-8'))
+                    if mimetype[0] is not None and mimetype[0].split('/')[0] == 'image':
+                        raw = open(filepath, 'rb') # pylint: disable=consider-using-with
+                    else:
+                        content = load_file(filepath).decode("utf-8")
+                else:
+                    content = "File not found"
+        except Exception as err:
+            LOG.warning(err)
+            content = str(err)
+        if raw is not None:
+            with raw:
+                self.send_file(raw, mimetype[0])
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'text/text')
+        self.end_headers()
+        self.wfile.write(bytes(content, "utf8"))
+
+    def api_download(self, req, query):
+        """Handle GET /api/download."""
+        content = ""
+        filename = query.get('filename', None)
+        try:
+            if filename:
+                filename = unquote(filename[0]).encode('utf-8')
+                if ENFORCE_BASEPATH and not is_safe_path(BASEPATH, filename):
+                    raise OSError('Access denied.')
+                LOG.info(filename)
+                filepath = os.path.join(BASEDIR.encode('utf-8'), filename)
+                if os.path.isfile(filepath):
+                    disposition = 'attachment; filename=%s' % \
+                        filename.decode('utf-8').split(os.sep)[-1]
+                    with open(filepath, 'rb') as fptr:
+                        self.send_file(fptr, headers=[('Content-Disposition', disposition)])
+                    return
+                content = "File not found"
+        except Exception as err:
+            LOG.warning(err)
+            content = str(err)
+        self.send_response(200)
+        self.send_header('Content-type', 'text/text')
+        self.end_headers()
+        self.wfile.write(bytes(content, "utf8"))
+
+    def api_tail(self, req, query):
+        """Handle GET /api/tail."""
+        res = {"error": True, "message": "Generic failure"}
+        follow = None
+        filename = query.get('filename', None)
+        try:
+            length = int_param(query, 'length', TAIL_MAX_BYTES, 1, TAIL_MAX_BYTES)
+            lines = int_param(query, 'lines', 500, 1)
+            offset = int_param(query, 'offset', 0, 0)
+            end = int_param(query, 'end', sys.maxsize, 0)
+        except ValueError as err:
+            self.send_response(400)
+            self.send_header('Content-type', 'text/json')
+            self.end_headers()
+            self.wfile.write(bytes(json.dumps({"error": True, "message": str(err)}), "utf8"))
+            return
+        try:
+            if not filename:
+                raise ValueError("Missing filename")
+            filename = unquote(filename[0]).encode('utf-8')
+            if ENFORCE_BASEPATH and not is_safe_path(BASEPATH, filename):
+                raise OSError('Access denied.')
+            filepath = os.path.join(BASEDIR.encode('utf-8'), filename)
+            if not os.path.isfile(filepath):
+                raise OSError("File not found")
+            with open(filepath, 'rb') as fptr:
+                size = os.fstat(fptr.fileno()).st_size
+                if 'follow' in query:
+                    offset = self.headers.get(
+                        'Last-Event-ID', query.get('offset', [str(size)])[0])
+                    follow = int(offset) if offset.isdigit() else size
+                elif 'offset' in query:
+                    start = min(offset, size)
+                    fptr.seek(start)
+                    data = fptr.read(length)
+                    end = start + len(data)
+                    if end < size and data.rfind(b"\n") >= 0:
+                        # End the window with a complete line
+                        data = data[:data.rfind(b"\n") + 1]
+                        end = start + len(data)
+                else:
+                    end = min(end, size)
+                    start = find_line_start(fptr, end, lines, length)
+                    fptr.seek(start)
+                    data = fptr.read(end - start)
+            if follow is None:
+                res = {
+                    "error": False,
+                    "filename": filename.decode('utf-8'),
+                    "size": size,
+                    "start": start,
+                    "end": end,
+                    "text": data.decode('utf-8', errors='replace')
+                }
+        except Exception as err:
+            LOG.warning(err)
+            res = {"error": True, "message": "%s" % (str(err))}
+        if follow is not None:
+            self.follow_file(filepath, follow)
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'text/json')
+        self.end_headers()
+        self.wfile.write(bytes(json.dumps(res), "utf8"))
+
+    def follow_file(self, filepath, offset):
+        """Send data appended to a file as server-sent events until the client
+        has gone away. Event ids are file offsets to resume from."""
+        self.run_stream(self.follow_file_async(filepath, offset))
+
+    async def follow_file_async(self, filepath, offset):
+        """Coroutine polling a file for new data."""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        waited = 0
+        self.start_stream('text/event-stream')
+        fptr = open(filepath, 'rb') # pylint: disable=consider-using-with
+        try:
+            while True:
+                stat = os.fstat(fptr.fileno())
+                if stat.st_size < offset:
+                    # The file has been truncated
+                    offset = 0
+                    decoder.reset()
+                    self.write_event('reset', {"size": stat.st_size}, 0)
+                if stat.st_size > offset:
+                    fptr.seek(offset)
+                    data = fptr.read(min(stat.st_size - offset, TAIL_MAX_BYTES))
+                    self.write_event('data', {
+                        "start": offset,
+                        "end": offset + len(data),
+                        "text": decoder.decode(data)
+                    }, offset + len(data))
+                    offset += len(data)
+                    waited = 0
+                    await self.flush_async()
+                    continue
+                try:
+                    rotated = os.stat(filepath).st_ino != stat.st_ino
+                except OSError:
+                    rotated = False
+                if rotated:
+                    # Continue with the file that replaced the one read so far
+                    fptr.close()
+                    fptr = open(filepath, 'rb') # pylint: disable=consider-using-with
+                    offset = 0
+                    decoder.reset()
+                    self.write_event('reset', {"size": os.fstat(fptr.fileno()).st_size}, 0)
+                    continue
+                await asyncio.sleep(TAIL_POLL_INTERVAL)
+                waited += TAIL_POLL_INTERVAL
+                if waited >= CONNECTION_IDLE_TIMEOUT:
+                    # Notice clients that have gone away
+                    self.write_chunk(b": keep-alive\n\n")
+                    await self.flush_async()
+                    waited = 0
+        finally:
+            fptr.close()
+
+    def api_listdir(self, req, query):
+        """Handle GET /api/listdir."""
+        self.send_response(200)
+        content = {'error': None}
+        self.send_header('Content-type', 'text/json')
+        self.end_headers()
+        dirpath = query.get('path', None)
+        try:
+            if dirpath:
+                dirpath = unquote(dirpath[0]).encode('utf-8')
+                if os.path.isdir(dirpath):
+                    if ENFORCE_BASEPATH and not is_safe_path(BASEPATH,
+                                                             dirpath):
+                        raise OSError('Access denied.')
+                    repo = None
+                    activebranch = None
+                    dirty = False
+                    branches = []
+                    if REPO:
+                        try:
+                            repo = REPO_POOL.get(dirpath.decode('utf-8'))
+                            activebranch, dirty, branches = GIT_STATUS_CACHE.get(
+                                (repo.working_dir, None), GIT_STATUS_CACHE.signature(repo),
+                                lambda: git_repo_info(repo))
                         except Exception as err:
-                            LOG.warning(err)
-                            response['error'] = True
-                            response['message'] = str(err)
+                            LOG.debug("Exception (no repo): %s", str(err))
+                    dircontent = get_dircontent(dirpath.decode('utf-8'), repo)
+                    filedata = {
+                        'content': dircontent,
+                        'abspath': os.path.abspath(dirpath).decode('utf-8'),
+                        'parent': os.path.dirname(os.path.abspath(dirpath)).decode('utf-8'),
+                        'branches': branches,
+                        'activebranch': activebranch,
+                        'dirty': dirty,
+                        'error': None
+                    }
+                    self.wfile.write(bytes(json.dumps(filedata), "utf8"))
+        except Exception as err:
+            LOG.warning(err)
+            content['error'] = str(err)
+            self.wfile.write(bytes(json.dumps(content), "utf8"))
 
-                    except Exception as err:
-                        response['message'] = "%s" % (str(err))
-                        LOG.warning(err)
+    def api_abspath(self, req, query):
+        """Handle GET /api/abspath."""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/text')
+        self.end_headers()
+        dirpath = query.get('path', None)
+        if dirpath:
+            dirpath = unquote(dirpath[0]).encode('utf-8')
+            LOG.debug(dirpath)
+            absp = os.path.abspath(dirpath)
+            LOG.debug(absp)
+            if os.path.isdir(dirpath):
+                self.wfile.write(os.path.abspath(dirpath))
+
+    def api_parent(self, req, query):
+        """Handle GET /api/parent."""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/text')
+        self.end_headers()
+        dirpath = query.get('path', None)
+        if dirpath:
+            dirpath = unquote(dirpath[0]).encode('utf-8')
+            LOG.debug(dirpath)
+            absp = os.path.abspath(dirpath)
+            LOG.debug(absp)
+            if os.path.isdir(dirpath):
+                self.wfile.write(os.path.abspath(os.path.dirname(dirpath)))
+
+    def api_netstat(self, req, query):
+        """Handle GET /api/netstat."""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/json')
+        self.end_headers()
+        res = {
+            "allowed_networks": ALLOWED_NETWORKS,
+            "banned_ips": BANNED_IPS
+        }
+        self.wfile.write(bytes(json.dumps(res), "utf8"))
+
+    def api_gitjob(self, req, query):
+        """Handle GET /api/gitjob."""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/json')
+        self.end_headers()
+        res = GIT_JOBS.get(query.get('id', [None])[0])
+        if res is None:
+            res = {"error": True, "message": "Unknown job"}
+        self.wfile.write(bytes(json.dumps(res), "utf8"))
+
+    def call_hass_service(self, name, service, passthrough=False):
+        """Call a HASS service and send the result to the client."""
+        LOG.info("/api/%s", name)
+        self.run_async(self.hass_service_async(name, service, passthrough))
+
+    async def hass_service_async(self, name, service, passthrough):
+        """Wait for a HASS service call, made on a pooled connection by the
+        executor of the event loop."""
+        res = {name: False}
+        try:
+            result = json.loads(await asyncio.get_running_loop().run_in_executor(
+                None, hass_api_request, 'POST', "services/%s" % service, None,
+                HASS_SERVICE_TIMEOUT))
+            LOG.debug(result)
+            if passthrough:
+                res = result
             else:
-                response['message'] = "Missing filename or text"
-        elif req.path.endswith('/api/delete'):
+                res['service'] = "called successfully"
+        except Exception as err:
+            LOG.warning(err)
+            res['restart'] = str(err)
+        self.write_json(res)
+
+    def api_restart(self, req, query):
+        """Handle GET /api/restart."""
+        self.call_hass_service('restart', 'homeassistant/restart', passthrough=True)
+
+    def api_check_config(self, req, query):
+        """Handle GET /api/check_config."""
+        self.call_hass_service('check_config', 'homeassistant/check_config', passthrough=True)
+
+    def api_reload_automations(self, req, query):
+        """Handle GET /api/reload_automations."""
+        self.call_hass_service('reload_automations', 'automation/reload')
+
+    def api_reload_scripts(self, req, query):
+        """Handle GET /api/reload_scripts."""
+        self.call_hass_service('reload_scripts', 'script/reload')
+
+    def api_reload_groups(self, req, query):
+        """Handle GET /api/reload_groups."""
+        self.call_hass_service('reload_groups', 'group/reload')
+
+    def api_reload_core(self, req, query):
+        """Handle GET /api/reload_core."""
+        self.call_hass_service('reload_core', 'homeassistant/reload_core_config')
+
+    def serve_index(self, req, query):
+        """Handle GET /."""
+        loadfile = query.get('loadfile', [None])[0]
+        if loadfile is None:
+            loadfile = 'null'
+        else:
+            loadfile = "'%s'" % loadfile
+        template = INDEX_TEMPLATE
+        try:
+            if template is None or DEV:
+                template = compile_index_template()
+            data = render_index(
+                template,
+                loadfile=loadfile,
+                your_address=self.client_address[0])
+        except Exception as err:
+            LOG.warning("Error getting html: %s", err)
+            data = bytes(ERROR_HTML, "utf8")
+        self.send_cacheable(data, 'text/html')
+
+    def api_bootstrap(self, req, query):
+        """Handle GET /api/bootstrap."""
+        bootstrap = BOOTSTRAP_EMPTY
+        if HASS_API:
+            bootstrap = BOOTSTRAP.get()
+        include = query.get('include', ["services,events,states"])[0].split(',')
+        prefix = query.get('prefix', [None])[0]
+        parts = []
+        for key in ("services", "events", "states"):
+            if key not in include:
+                continue
+            value = bootstrap[key]
+            if key == "states" and prefix:
+                if REGISTRY.ready:
+                    states = REGISTRY.states(prefix)
+                else:
+                    states = [state for state in json.loads(value)
+                              if state["entity_id"].startswith(prefix)]
+                value = json.dumps(states)
+            parts.append('"%s": %s' % (key, value))
+        self.send_cacheable(bytes("{%s}" % ", ".join(parts), "utf8"), 'text/json')
+
+    def send_cacheable(self, data, content_type):
+        """Send a generated response with ETag validation and compression."""
+        etag = 'W/"%s"' % hashlib.sha1(data).hexdigest()
+        if is_not_modified(self.headers, etag):
+            self.send_not_modified(etag, CACHE_CONTROL_REVALIDATE, vary=True)
+            return
+        encoding = None
+        if len(data) >= COMPRESSION_MIN_SIZE and \
+                'gzip' in accepted_encodings(self.headers.get('Accept-Encoding')):
+            data = gzip_cached(etag, data)
+            encoding = 'gzip'
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', CACHE_CONTROL_REVALIDATE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def api_save(self, req, length, response):
+        """Handle POST /api/save."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'filename' in postvars.keys() and 'text' in postvars.keys():
+            if postvars['filename'] and postvars['text']:
+                try:
+                    filename = unquote(postvars['filename'][0])
+                    response['file'] = filename
+                    with open(filename, 'wb') as fptr:
+                        fptr.write(bytes(postvars['text'][0], "utf-8"))
+                    self.send_response(200)
+                    self.send_header('Content-type', 'text/json')
+                    self.end_headers()
+                    response['error'] = False
+                    response['message'] = "File saved successfully"
+                    self.wfile.write(bytes(json.dumps(response), "utf8"))
+                    return True
+                except Exception as err:
+                    response['message'] = "%s" % (str(err))
+                    LOG.warning(err)
+        else:
+            response['message'] = "Missing filename or text"
+        return False
+
+    def api_upload(self, req, length, response):
+        """Handle POST /api/upload."""
+        if length > UPLOAD_MAX_SIZE:
+            # Reject without receiving the body, the connection can't be reused
+            self.close_connection = True
+            response['message'] = "File too big: %i" % length
+            return False
+        boundary = self.headers.get_param('boundary')
+        if self.headers.get_content_type() != 'multipart/form-data' or not boundary:
+            self.rfile.read(length)
+            response['message'] = "Invalid upload"
+            return False
+        parser = MultipartParser(self.rfile, boundary.encode('latin-1'), length)
+        filepath = None
+        filename = None
+        tmpname = None
+        try:
+            while True:
+                headers = parser.next_part()
+                if headers is None:
+                    break
+                name = headers.get_param('name', header='content-disposition')
+                if name == 'path':
+                    filepath = bytearray()
+                    for chunk in parser.read():
+                        filepath += chunk
+                        if len(filepath) > 4096:
+                            raise ValueError("Path too long")
+                    filepath = filepath.decode('utf-8')
+                elif name == 'file' and tmpname is None:
+                    filename = os.path.basename(headers.get_filename() or "")
+                    # Write to the target directory if it's known already
+                    tmpname = os.path.join(filepath or tempfile.gettempdir(),
+                                           ".upload-%s" % uuid.uuid4().hex)
+                    with open(tmpname, "xb") as fptr:
+                        for chunk in parser.read():
+                            fptr.write(chunk)
+                else:
+                    for _ in parser.read():
+                        pass
+            if tmpname is None or filepath is None or not filename:
+                raise ValueError("Missing file or path")
+            destination = "%s%s%s" % (filepath, os.sep, filename)
+            if os.path.dirname(os.path.abspath(tmpname)) == \
+                    os.path.dirname(os.path.abspath(destination)):
+                os.replace(tmpname, destination)
+            else:
+                shutil.move(tmpname, destination)
+            tmpname = None
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            return False
+        finally:
+            parser.drain()
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+        self.send_response(200)
+        self.send_header('Content-type', 'text/json')
+        self.end_headers()
+        response['error'] = False
+        response['message'] = "Upload successful"
+        self.wfile.write(bytes(json.dumps(response), "utf8"))
+        return True
+
+    def api_upload_init(self, req, length, response):
+        """Handle POST /api/upload_init."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if all(postvars.get(key) for key in ('path', 'filename', 'size')):
             try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
+                filepath = unquote(postvars['path'][0])
+                filename = os.path.basename(unquote(postvars['filename'][0]))
+                if not filename or not os.path.isdir(filepath):
+                    raise OSError("Invalid path or filename")
+                if ENFORCE_BASEPATH and not is_safe_path(
+                        BASEPATH, os.path.join(filepath, filename).encode('utf-8')):
+                    raise OSError('Access denied.')
+                manifest = UPLOADS.create(
+                    filepath, filename, int(postvars['size'][0]),
+                    int(postvars.get('chunksize', [UPLOAD_CHUNK_SIZE])[0]))
+                response['error'] = False
+                response['message'] = "Upload started"
+                response['upload'] = manifest['id']
+                response['chunksize'] = manifest['chunksize']
+                response['chunks'] = manifest['chunks']
             except Exception as err:
                 LOG.warning(err)
                 response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys():
-                if postvars['path']:
-                    try:
-                        delpath = unquote(postvars['path'][0])
-                        response['path'] = delpath
-                        try:
-                            if os.path.isdir(delpath):
-                                os.rmdir(delpath)
-                            else:
-                                os.unlink(delpath)
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            response['error'] = False
-                            response['message'] = "Deletion successful"
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            LOG.warning(err)
-                            response['error'] = True
-                            response['message'] = str(err)
+        else:
+            response['message'] = "Missing path, filename or size"
+        return False
 
-                    except Exception as err:
-                        response['message'] = "%s" % (str(err))
-                        LOG.warning(err)
-            else:
-                response['message'] = "Missing filename or text"
-        elif req.path.endswith('/api/exec_command'):
+    def api_upload_chunk(self, req, length, response):
+        """Handle PUT /api/upload_chunk."""
+        query = parse_qs(req.query)
+        try:
+            manifest = UPLOADS.get(query.get('upload', [None])[0])
+            index = int(query.get('index', ['-1'])[0])
+            expected = UPLOADS.chunk_length(manifest, index)
+            algorithm = next((name for name in UPLOADS.checksums if name in query), None)
+            if algorithm is None:
+                raise ValueError("Missing checksum")
+            if length != expected:
+                raise ValueError("Chunk %i has to contain %i bytes" % (index, expected))
+        except Exception as err:
+            # Nothing has been read yet, don't accept the body
+            LOG.warning(err)
+            self.close_connection = True
+            response['message'] = "%s" % (str(err))
+            return False
+        try:
+            UPLOADS.write(manifest, index, self.rfile, algorithm, query[algorithm][0])
+            response['error'] = False
+            response['message'] = "Chunk %i received" % index
+        except ValueError as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+        except Exception as err:
+            LOG.warning(err)
+            self.close_connection = True
+            response['message'] = "%s" % (str(err))
+        return False
+
+    def api_upload_status(self, req, query):
+        """Handle GET /api/upload_status."""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/json')
+        self.end_headers()
+        upload_id = query.get('upload', [None])[0]
+        try:
+            manifest = UPLOADS.get(upload_id)
+            received = UPLOADS.received(upload_id)
+            res = {
+                "error": False,
+                "upload": upload_id,
+                "size": manifest['size'],
+                "chunksize": manifest['chunksize'],
+                "chunks": manifest['chunks'],
+                "received": received,
+                "missing": sorted(set(range(manifest['chunks'])) - set(received))
+            }
+        except Exception as err:
+            res = {"error": True, "message": "%s" % (str(err))}
+        self.wfile.write(bytes(json.dumps(res), "utf8"))
+
+    def api_upload_finalize(self, req, length, response):
+        """Handle POST /api/upload_finalize."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'upload' in postvars.keys() and postvars['upload']:
             try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
+                manifest = UPLOADS.finish(postvars['upload'][0])
+                response['error'] = False
+                response['message'] = "Upload successful"
+                response['file'] = manifest['destination']
             except Exception as err:
                 LOG.warning(err)
                 response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'command' in postvars.keys():
-                if postvars['command']:
-                    try:
-                        command = shlex.split(postvars['command'][0])
-                        timeout = 15
-                        if 'timeout' in postvars.keys():
-                            if postvars['timeout']:
-                                timeout = int(postvars['timeout'][0])
-                        try:
-                            proc = subprocess.Popen(
-                                command,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-                            stdout, stderr = proc.communicate(timeout=timeout)
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            response['error'] = False
-                            response['message'] = "Command executed: %s" % postvars['command'][0]
-                            response['returncode'] = proc.returncode
-                            try:
-                                response['stdout'] = stdout.decode(sys.getdefaultencoding())
-                            except Exception as err:
-                                LOG.warning(err)
-                                response['stdout'] = stdout.decode("utf-8", errors="replace")
-                            try:
-                                response['stderr'] = stderr.decode(sys.getdefaultencoding())
-                            except Exception as err:
-                                LOG.warning(err)
-                                response['stderr'] = stderr.decode("utf-8", errors="replace")
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            LOG.warning(err)
-                            response['error'] = True
-                            response['message'] = str(err)
+        else:
+            response['message'] = "Missing upload"
+        return False
 
-                    except Exception as err:
-                        response['message'] = "%s" % (str(err))
-                        LOG.warning(err)
-            else:
-                response['message'] = "Missing command"
-        elif req.path.endswith('/api/gitadd'):
+    def api_upload_abort(self, req, length, response):
+        """Handle POST /api/upload_abort."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'upload' in postvars.keys() and postvars['upload']:
             try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
+                UPLOADS.abort(postvars['upload'][0])
+                response['error'] = False
+                response['message'] = "Upload aborted"
             except Exception as err:
                 LOG.warning(err)
                 response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys():
-                if postvars['path']:
+        else:
+            response['message'] = "Missing upload"
+        return False
+
+    def api_rename(self, req, length, response):
+        """Handle POST /api/rename."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'src' in postvars.keys() and 'dstfilename' in postvars.keys():
+            if postvars['src'] and postvars['dstfilename']:
+                try:
+                    src = unquote(postvars['src'][0])
+                    dstfilename = unquote(postvars['dstfilename'][0])
+                    renamepath = src[:src.index(os.path.basename(src))] + dstfilename
+                    response['path'] = renamepath
                     try:
-                        addpath = unquote(postvars['path'][0])
-                        # pylint: disable=not-callable
-                        repo = REPO(addpath,
-                                    search_parent_directories=True)
-                        filepath = "/".join(
-                            addpath.split(os.sep)[len(repo.working_dir.split(os.sep)):])
-                        response['path'] = filepath
-                        try:
-                            repo.index.add([filepath])
-                            response['error'] = False
-                            response['message'] = "Added file to index"
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            LOG.warning(err)
-                            response['error'] = True
-                            response['message'] = str(err)
+                        os.rename(src, renamepath)
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        response['error'] = False
+                        response['message'] = "Rename successful"
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
+                    except Exception as err:
+                        LOG.warning(err)
+                        response['error'] = True
+                        response['message'] = str(err)
 
+                except Exception as err:
+                    response['message'] = "%s" % (str(err))
+                    LOG.warning(err)
+        else:
+            response['message'] = "Missing filename or text"
+        return False
+
+    def api_delete(self, req, length, response):
+        """Handle POST /api/delete."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys():
+            if postvars['path']:
+                try:
+                    delpath = unquote(postvars['path'][0])
+                    response['path'] = delpath
+                    try:
+                        if os.path.isdir(delpath):
+                            os.rmdir(delpath)
+                        else:
+                            os.unlink(delpath)
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        response['error'] = False
+                        response['message'] = "Deletion successful"
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
                     except Exception as err:
-                        response['message'] = "%s" % (str(err))
                         LOG.warning(err)
+                        response['error'] = True
+                        response['message'] = str(err)
+
+                except Exception as err:
+                    response['message'] = "%s" % (str(err))
+                    LOG.warning(err)
+        else:
+            response['message'] = "Missing filename or text"
+        return False
+
+    def api_exec_command(self, req, length, response):
+        """Handle POST /api/exec_command."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'command' in postvars.keys():
+            if postvars['command']:
+                try:
+                    command = shlex.split(postvars['command'][0])
+                    timeout = 15
+                    if 'timeout' in postvars.keys():
+                        if postvars['timeout']:
+                            timeout = int(postvars['timeout'][0])
+                    if postvars.get('stream', [''])[0] in ('1', 'true'):
+                        self.stream_job(COMMANDS.start(command, postvars['command'][0], timeout))
+                    else:
+                        job = COMMANDS.start(command, postvars['command'][0], timeout,
+                                             EXEC_RESULT_MAX_SIZE)
+                        self.run_async(self.command_result_async(job, response))
+                    return True
+                except Exception as err:
+                    response['message'] = "%s" % (str(err))
+                    LOG.warning(err)
+        else:
+            response['message'] = "Missing command"
+        return False
+
+    async def command_result_async(self, job, response):
+        """Send the output of a command job once it has finished."""
+        if not await job.wait_async(lambda: job.state != "queued", COMMAND_QUEUE_TIMEOUT):
+            COMMANDS.cancel(job)
+            response['error'] = True
+            response['message'] = "Busy, all %i command slots are in use" % MAX_COMMANDS
+            self.write_json(response)
+            return
+        # The output of a process killed after its timeout is read for up to 1 second
+        if not await job.wait_async(lambda: job.finished is not None, job.timeout + 5):
+            response['error'] = True
+            response['message'] = "Command did not finish: %s" % job.command
+            self.write_json(response)
+            return
+        if job.state != "finished":
+            response['error'] = True
+            response['message'] = job.message
+            self.write_json(response)
+            return
+        response['error'] = False
+        response['message'] = "Command executed: %s" % job.command
+        response['returncode'] = job.returncode
+        with job.condition:
+            response['stdout'] = "".join(job.collected['stdout'])
+            response['stderr'] = "".join(job.collected['stderr'])
+            response['truncated'] = job.truncated
+        self.write_json(response)
+
+    def stream_job(self, job, since=0):
+        """Relay the output of a command job as server-sent events until it
+        has finished."""
+        self.run_stream(self.stream_job_async(job, since))
+
+    async def stream_job_async(self, job, since):
+        """Coroutine streaming the output of a command job."""
+        self.start_stream('text/event-stream')
+        self.write_event('job', job.as_dict())
+        while True:
+            await self.flush_async()
+            chunks, done = await job.read_async(since, CONNECTION_IDLE_TIMEOUT)
+            if chunks and chunks[0][0] > since + 1:
+                self.write_event('truncated', chunks[0][0] - since - 1)
+            for seq, name, text in chunks:
+                self.write_event(name, text, seq)
+                since = seq
+            if done:
+                break
+            if not chunks:
+                # Notice clients that have gone away
+                self.write_chunk(b": keep-alive\n\n")
+        self.write_event('exit', job.as_dict())
+        self.end_stream()
+
+    def api_commands(self, req, query):
+        """Handle GET /api/commands."""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/json')
+        self.end_headers()
+        if PROCESSES > 1:
+            res = {"error": True, "message": COMMANDS_SINGLE_PROCESS}
+        else:
+            res = [job.as_dict() for job in COMMANDS.list()]
+        self.wfile.write(bytes(json.dumps(res), "utf8"))
+
+    def api_command_output(self, req, query):
+        """Handle GET /api/command_output."""
+        job = COMMANDS.get(query.get('job', [None])[0])
+        if job is None or PROCESSES > 1:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/json')
+            self.end_headers()
+            res = {"error": True, "message": "Unknown command"}
+            if PROCESSES > 1:
+                res['message'] = COMMANDS_SINGLE_PROCESS
+            self.wfile.write(bytes(json.dumps(res), "utf8"))
+            return
+        since = self.headers.get('Last-Event-ID', query.get('since', ['0'])[0])
+        self.stream_job(job, int(since) if since.isdigit() else 0)
+
+    def api_cancel_command(self, req, length, response):
+        """Handle POST /api/cancel_command."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if PROCESSES > 1:
+            response['message'] = COMMANDS_SINGLE_PROCESS
+        elif 'job' in postvars.keys() and postvars['job']:
+            job = COMMANDS.get(postvars['job'][0])
+            if job is None:
+                response['message'] = "Unknown command"
+            elif job.finished is not None:
+                response['message'] = job.message
             else:
-                response['message'] = "Missing filename"
-        elif req.path.endswith('/api/gitdiff'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys():
-                if postvars['path']:
+                kill = postvars.get('kill', [''])[0] in ('1', 'true')
+                COMMANDS.cancel(job, kill)
+                response['error'] = False
+                response['message'] = "%s command: %s" % (
+                    "Killed" if kill else "Stopped", job.command)
+        else:
+            response['message'] = "Missing job"
+        return False
+
+    def api_gitadd(self, req, length, response):
+        """Handle POST /api/gitadd."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys():
+            if postvars['path']:
+                try:
+                    addpath = unquote(postvars['path'][0])
+                    repo = REPO_POOL.get(addpath)
+                    filepath = "/".join(
+                        addpath.split(os.sep)[len(repo.working_dir.split(os.sep)):])
+                    response['path'] = filepath
                     try:
-                        diffpath = unquote(postvars['path'][0])
-                        # pylint: disable=not-callable
-                        repo = REPO(diffpath,
-                                    search_parent_directories=True)
-                        filepath = "/".join(
-                            diffpath.split(os.sep)[len(repo.working_dir.split(os.sep)):])
-                        response['path'] = filepath
-                        try:
+                        with REPO_POOL.lock(repo):
+                            repo.index.add([filepath])
+                        response['error'] = False
+                        response['message'] = "Added file to index"
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
+                    except Exception as err:
+                        LOG.warning(err)
+                        response['error'] = True
+                        response['message'] = str(err)
+
+                except Exception as err:
+                    response['message'] = "%s" % (str(err))
+                    LOG.warning(err)
+        else:
+            response['message'] = "Missing filename"
+        return False
+
+    def api_gitdiff(self, req, length, response):
+        """Handle POST /api/gitdiff."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys():
+            if postvars['path']:
+                try:
+                    diffpath = unquote(postvars['path'][0])
+                    repo = REPO_POOL.get(diffpath)
+                    filepath = "/".join(
+                        diffpath.split(os.sep)[len(repo.working_dir.split(os.sep)):])
+                    response['path'] = filepath
+                    try:
+                        with REPO_POOL.lock(repo):
                             diff = repo.index.diff(None,
                                                    create_patch=True,
                                                    paths=filepath)[0].diff.decode("utf-8")
-                            response['error'] = False
-                            response['message'] = diff
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            LOG.warning(err)
-                            response['error'] = True
-                            response['message'] = "Unable to load diff: %s" % str(err)
-
+                        response['error'] = False
+                        response['message'] = diff
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
                     except Exception as err:
-                        response['message'] = "%s" % (str(err))
                         LOG.warning(err)
-            else:
-                response['message'] = "Missing filename"
-        elif req.path.endswith('/api/commit'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys() and 'message' in postvars.keys():
-                if postvars['path'] and postvars['message']:
+                        response['error'] = True
+                        response['message'] = "Unable to load diff: %s" % str(err)
+
+                except Exception as err:
+                    response['message'] = "%s" % (str(err))
+                    LOG.warning(err)
+        else:
+            response['message'] = "Missing filename"
+        return False
+
+    def api_commit(self, req, length, response):
+        """Handle POST /api/commit."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys() and 'message' in postvars.keys():
+            if postvars['path'] and postvars['message']:
+                try:
+                    commitpath = unquote(postvars['path'][0])
+                    response['path'] = commitpath
+                    message = unquote(postvars['message'][0])
+                    repo = REPO_POOL.get(commitpath)
                     try:
-                        commitpath = unquote(postvars['path'][0])
-                        response['path'] = commitpath
-                        message = unquote(postvars['message'][0])
-                        # pylint: disable=not-callable
-                        repo = REPO(commitpath,
-                                    search_parent_directories=True)
-                        try:
+                        with REPO_POOL.lock(repo):
                             repo.index.commit(message)
-                            response['error'] = False
-                            response['message'] = "Changes commited"
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            response['error'] = True
-                            response['message'] = str(err)
-                            LOG.debug(response)
-
+                        response['error'] = False
+                        response['message'] = "Changes commited"
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
                     except Exception as err:
-                        response['message'] = "Not a git repository: %s" % (str(err))
-                        LOG.warning("Exception (no repo): %s", str(err))
-            else:
-                response['message'] = "Missing path"
-        elif req.path.endswith('/api/checkout'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys() and 'branch' in postvars.keys():
-                if postvars['path'] and postvars['branch']:
+                        response['error'] = True
+                        response['message'] = str(err)
+                        LOG.debug(response)
+
+                except Exception as err:
+                    response['message'] = "Not a git repository: %s" % (str(err))
+                    LOG.warning("Exception (no repo): %s", str(err))
+        else:
+            response['message'] = "Missing path"
+        return False
+
+    def api_checkout(self, req, length, response):
+        """Handle POST /api/checkout."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys() and 'branch' in postvars.keys():
+            if postvars['path'] and postvars['branch']:
+                try:
+                    branchpath = unquote(postvars['path'][0])
+                    response['path'] = branchpath
+                    branch = unquote(postvars['branch'][0])
+                    repo = REPO_POOL.get(branchpath)
                     try:
-                        branchpath = unquote(postvars['path'][0])
-                        response['path'] = branchpath
-                        branch = unquote(postvars['branch'][0])
-                        # pylint: disable=not-callable
-                        repo = REPO(branchpath,
-                                    search_parent_directories=True)
-                        try:
+                        with REPO_POOL.lock(repo):
                             head = [h for h in repo.heads if h.name == branch][0]
                             head.checkout()
-                            response['error'] = False
-                            response['message'] = "Checked out %s" % branch
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            response['error'] = True
-                            response['message'] = str(err)
-                            LOG.warning(response)
-
+                        response['error'] = False
+                        response['message'] = "Checked out %s" % branch
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
                     except Exception as err:
-                        response['message'] = "Not a git repository: %s" % (str(err))
-                        LOG.warning("Exception (no repo): %s", str(err))
-            else:
-                response['message'] = "Missing path or branch"
-        elif req.path.endswith('/api/newbranch'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys() and 'branch' in postvars.keys():
-                if postvars['path'] and postvars['branch']:
+                        response['error'] = True
+                        response['message'] = str(err)
+                        LOG.warning(response)
+
+                except Exception as err:
+                    response['message'] = "Not a git repository: %s" % (str(err))
+                    LOG.warning("Exception (no repo): %s", str(err))
+        else:
+            response['message'] = "Missing path or branch"
+        return False
+
+    def api_newbranch(self, req, length, response):
+        """Handle POST /api/newbranch."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys() and 'branch' in postvars.keys():
+            if postvars['path'] and postvars['branch']:
+                try:
+                    branchpath = unquote(postvars['path'][0])
+                    response['path'] = branchpath
+                    branch = unquote(postvars['branch'][0])
+                    repo = REPO_POOL.get(branchpath)
                     try:
-                        branchpath = unquote(postvars['path'][0])
-                        response['path'] = branchpath
-                        branch = unquote(postvars['branch'][0])
-                        # pylint: disable=not-callable
-                        repo = REPO(branchpath,
-                                    search_parent_directories=True)
-                        try:
+                        with REPO_POOL.lock(repo):
                             repo.git.checkout("HEAD", b=branch)
-                            response['error'] = False
-                            response['message'] = "Created and checked out %s" % branch
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            response['error'] = True
-                            response['message'] = str(err)
-                            LOG.warning(response)
-
+                        response['error'] = False
+                        response['message'] = "Created and checked out %s" % branch
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
                     except Exception as err:
-                        response['message'] = "Not a git repository: %s" % (str(err))
-                        LOG.warning("Exception (no repo): %s", str(err))
-            else:
-                response['message'] = "Missing path or branch"
-        elif req.path.endswith('/api/init'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys():
-                if postvars['path']:
-                    try:
-                        repopath = unquote(postvars['path'][0])
-                        response['path'] = repopath
-                        try:
-                            repo = REPO.init(repopath)
-                            response['error'] = False
-                            response['message'] = "Initialized repository in %s" % repopath
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            response['error'] = True
-                            response['message'] = str(err)
-                            LOG.warning(response)
+                        response['error'] = True
+                        response['message'] = str(err)
+                        LOG.warning(response)
 
+                except Exception as err:
+                    response['message'] = "Not a git repository: %s" % (str(err))
+                    LOG.warning("Exception (no repo): %s", str(err))
+        else:
+            response['message'] = "Missing path or branch"
+        return False
+
+    def api_init(self, req, length, response):
+        """Handle POST /api/init."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys():
+            if postvars['path']:
+                try:
+                    repopath = unquote(postvars['path'][0])
+                    response['path'] = repopath
+                    try:
+                        REPO.init(repopath).close()
+                        REPO_POOL.reset_paths()
+                        response['error'] = False
+                        response['message'] = "Initialized repository in %s" % repopath
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
                     except Exception as err:
-                        response['message'] = "Not a git repository: %s" % (str(err))
-                        LOG.warning("Exception (no repo): %s", str(err))
-            else:
-                response['message'] = "Missing path or branch"
-        elif req.path.endswith('/api/push'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys():
-                if postvars['path']:
+                        response['error'] = True
+                        response['message'] = str(err)
+                        LOG.warning(response)
+
+                except Exception as err:
+                    response['message'] = "Not a git repository: %s" % (str(err))
+                    LOG.warning("Exception (no repo): %s", str(err))
+        else:
+            response['message'] = "Missing path or branch"
+        return False
+
+    def api_push(self, req, length, response):
+        """Handle POST /api/push."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys():
+            if postvars['path']:
+                try:
+                    repopath = unquote(postvars['path'][0])
+                    response['path'] = repopath
                     try:
-                        repopath = unquote(postvars['path'][0])
-                        response['path'] = repopath
-                        try:
-                            # pylint: disable=not-callable
-                            repo = REPO(repopath)
+                        repo = REPO_POOL.get(repopath, search_parent_directories=False)
+                        with REPO_POOL.lock(repo):
                             urls = []
                             if repo.remotes:
                                 for url in repo.remotes.origin.urls:
                                     urls.append(url)
-                            if not urls:
-                                response['error'] = True
-                                response['message'] = "No remotes configured for %s" % repopath
-                            else:
-                                repo.remotes.origin.push()
-                                response['error'] = False
-                                response['message'] = "Pushed to %s" % urls[0]
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
+                        if not urls:
                             response['error'] = True
-                            response['message'] = str(err)
-                            LOG.warning(response)
-
+                            response['message'] = "No remotes configured for %s" % repopath
+                        else:
+                            job = GIT_JOBS.submit("push", repopath,
+                                                  lambda job: git_push(repo, job))
+                            response['error'] = False
+                            response['message'] = "Pushing to %s" % urls[0]
+                            response['job'] = job.job_id
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
                     except Exception as err:
-                        response['message'] = "Not a git repository: %s" % (str(err))
-                        LOG.warning("Exception (no repo): %s", str(err))
-            else:
-                response['message'] = "Missing path or branch"
-        elif req.path.endswith('/api/stash'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys():
-                if postvars['path']:
+                        response['error'] = True
+                        response['message'] = str(err)
+                        LOG.warning(response)
+
+                except Exception as err:
+                    response['message'] = "Not a git repository: %s" % (str(err))
+                    LOG.warning("Exception (no repo): %s", str(err))
+        else:
+            response['message'] = "Missing path or branch"
+        return False
+
+    def api_stash(self, req, length, response):
+        """Handle POST /api/stash."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys():
+            if postvars['path']:
+                try:
+                    repopath = unquote(postvars['path'][0])
+                    response['path'] = repopath
                     try:
-                        repopath = unquote(postvars['path'][0])
-                        response['path'] = repopath
-                        try:
-                            # pylint: disable=not-callable
-                            repo = REPO(repopath)
+                        repo = REPO_POOL.get(repopath, search_parent_directories=False)
+                        with REPO_POOL.lock(repo):
                             returnvalue = repo.git.stash()
-                            response['error'] = False
-                            response['message'] = "%s\n%s" % (returnvalue, repopath)
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            response['error'] = True
-                            response['message'] = str(err)
-                            LOG.warning(response)
-
+                        response['error'] = False
+                        response['message'] = "%s\n%s" % (returnvalue, repopath)
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
                     except Exception as err:
-                        response['message'] = "Not a git repository: %s" % (str(err))
-                        LOG.warning("Exception (no repo): %s", str(err))
-            else:
-                response['message'] = "Missing path or branch"
-        elif req.path.endswith('/api/newfolder'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys() and 'name' in postvars.keys():
-                if postvars['path'] and postvars['name']:
+                        response['error'] = True
+                        response['message'] = str(err)
+                        LOG.warning(response)
+
+                except Exception as err:
+                    response['message'] = "Not a git repository: %s" % (str(err))
+                    LOG.warning("Exception (no repo): %s", str(err))
+        else:
+            response['message'] = "Missing path or branch"
+        return False
+
+    def api_newfolder(self, req, length, response):
+        """Handle POST /api/newfolder."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys() and 'name' in postvars.keys():
+            if postvars['path'] and postvars['name']:
+                try:
+                    basepath = unquote(postvars['path'][0])
+                    name = unquote(postvars['name'][0])
+                    response['path'] = os.path.join(basepath, name)
                     try:
-                        basepath = unquote(postvars['path'][0])
-                        name = unquote(postvars['name'][0])
-                        response['path'] = os.path.join(basepath, name)
-                        try:
-                            os.makedirs(response['path'])
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            response['error'] = False
-                            response['message'] = "Folder created"
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            LOG.warning(err)
-                            response['error'] = True
-                            response['message'] = str(err)
+                        os.makedirs(response['path'])
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        response['error'] = False
+                        response['message'] = "Folder created"
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
                     except Exception as err:
-                        response['message'] = "%s" % (str(err))
                         LOG.warning(err)
-        elif req.path.endswith('/api/newfile'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'path' in postvars.keys() and 'name' in postvars.keys():
-                if postvars['path'] and postvars['name']:
+                        response['error'] = True
+                        response['message'] = str(err)
+                except Exception as err:
+                    response['message'] = "%s" % (str(err))
+                    LOG.warning(err)
+        return False
+
+    def api_newfile(self, req, length, response):
+        """Handle POST /api/newfile."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'path' in postvars.keys() and 'name' in postvars.keys():
+            if postvars['path'] and postvars['name']:
+                try:
+                    basepath = unquote(postvars['path'][0])
+                    name = unquote(postvars['name'][0])
+                    response['path'] = os.path.join(basepath, name)
                     try:
-                        basepath = unquote(postvars['path'][0])
-                        name = unquote(postvars['name'][0])
-                        response['path'] = os.path.join(basepath, name)
-                        try:
-                            with open(response['path'], 'w') as fptr:
-                                fptr.write("")
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
-                            response['error'] = False
-                            response['message'] = "File created"
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
-                            return
-                        except Exception as err:
-                            LOG.warning(err)
-                            response['error'] = True
-                            response['message'] = str(err)
+                        with open(response['path'], 'w') as fptr:
+                            fptr.write("")
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/json')
+                        self.end_headers()
+                        response['error'] = False
+                        response['message'] = "File created"
+                        self.wfile.write(bytes(json.dumps(response), "utf8"))
+                        return True
                     except Exception as err:
-                        response['message'] = "%s" % (str(err))
                         LOG.warning(err)
-            else:
-                response['message'] = "Missing filename or text"
-        elif req.path.endswith('/api/allowed_networks'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'network' in postvars.keys() and 'method' in postvars.keys():
-                if postvars['network'] and postvars['method']:
-                    try:
-                        network = unquote(postvars['network'][0])
-                        method = unquote(postvars['method'][0])
-                        if method == 'remove':
+                        response['error'] = True
+                        response['message'] = str(err)
+                except Exception as err:
+                    response['message'] = "%s" % (str(err))
+                    LOG.warning(err)
+        else:
+            response['message'] = "Missing filename or text"
+        return False
+
+    def api_allowed_networks(self, req, length, response):
+        """Handle POST /api/allowed_networks."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'network' in postvars.keys() and 'method' in postvars.keys():
+            if postvars['network'] and postvars['method']:
+                try:
+                    network = unquote(postvars['network'][0])
+                    method = unquote(postvars['method'][0])
+                    if method == 'remove':
+                        with SHARED_STATE:
                             if network in ALLOWED_NETWORKS:
                                 ALLOWED_NETWORKS.remove(network)
                                 if not ALLOWED_NETWORKS:
                                     ALLOWED_NETWORKS.append("0.0.0.0/0")
-                            response['error'] = False
-                        elif method == 'add':
-                            ipaddress.ip_network(network)
+                        response['error'] = False
+                    elif method == 'add':
+                        ipaddress.ip_network(network)
+                        with SHARED_STATE:
                             ALLOWED_NETWORKS.append(network)
-                            response['error'] = False
-                        else:
-                            response['error'] = True
-                        self.send_response(200)
-                        self.send_header('Content-type', 'text/json')
-                        self.end_headers()
                         response['error'] = False
-                        response['message'] = "ALLOWED_NETWORKS (%s): %s" % (method, network)
-                        self.wfile.write(bytes(json.dumps(response), "utf8"))
-                        return
-                    except Exception as err:
+                    else:
                         response['error'] = True
-                        response['message'] = "%s" % (str(err))
-                        LOG.warning(err)
-            else:
-                response['message'] = "Missing network"
-        elif req.path.endswith('/api/banned_ips'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                LOG.warning(err)
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'ip' in postvars.keys() and 'method' in postvars.keys():
-                if postvars['ip'] and postvars['method']:
-                    try:
-                        ip_address = unquote(postvars['ip'][0])
-                        method = unquote(postvars['method'][0])
-                        if method == 'unban':
+                    self.send_response(200)
+                    self.send_header('Content-type', 'text/json')
+                    self.end_headers()
+                    response['error'] = False
+                    response['message'] = "ALLOWED_NETWORKS (%s): %s" % (method, network)
+                    self.wfile.write(bytes(json.dumps(response), "utf8"))
+                    return True
+                except Exception as err:
+                    response['error'] = True
+                    response['message'] = "%s" % (str(err))
+                    LOG.warning(err)
+        else:
+            response['message'] = "Missing network"
+        return False
+
+    def api_banned_ips(self, req, length, response):
+        """Handle POST /api/banned_ips."""
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
+                                keep_blank_values=1)
+        except Exception as err:
+            LOG.warning(err)
+            response['message'] = "%s" % (str(err))
+            postvars = {}
+        if 'ip' in postvars.keys() and 'method' in postvars.keys():
+            if postvars['ip'] and postvars['method']:
+                try:
+                    ip_address = unquote(postvars['ip'][0])
+                    method = unquote(postvars['method'][0])
+                    if method == 'unban':
+                        with SHARED_STATE:
                             if ip_address in BANNED_IPS:
                                 BANNED_IPS.remove(ip_address)
-                            response['error'] = False
-                        elif method == 'ban':
-                            ipaddress.ip_network(ip_address)
+                        response['error'] = False
+                    elif method == 'ban':
+                        ipaddress.ip_network(ip_address)
+                        with SHARED_STATE:
                             BANNED_IPS.append(ip_address)
-                        else:
-                            response['error'] = True
-                        self.send_response(200)
-                        self.send_header('Content-type', 'text/json')
-                        self.end_headers()
-                        response['message'] = "BANNED_IPS (%s): %s" % (method, ip_address)
-                        self.wfile.write(bytes(json.dumps(response), "utf8"))
-                        return
-                    except Exception as err:
+                    else:
                         response['error'] = True
-                        response['message'] = "%s" % (str(err))
-                        LOG.warning(err)
-            else:
-                response['message'] = "Missing IP"
+                    self.send_response(200)
+                    self.send_header('Content-type', 'text/json')
+                    self.end_headers()
+                    response['message'] = "BANNED_IPS (%s): %s" % (method, ip_address)
+                    self.wfile.write(bytes(json.dumps(response), "utf8"))
+                    return True
+                except Exception as err:
+                    response['error'] = True
+                    response['message'] = "%s" % (str(err))
+                    LOG.warning(err)
         else:
-            response['message'] = "Invalid method"
-        self.send_response(200)
-        self.send_header('Content-type', 'text/json')
-        self.end_headers()
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
-        return
+            response['message'] = "Missing IP"
+        return False
 
 class AuthHandler(RequestHandler):
     """Handler to verify auth header."""
     def do_BLOCK(self, status=420, reason="Policy not fulfilled"):
+        self.close_connection = True
         self.send_response(status)
         self.end_headers()
         self.wfile.write(bytes(reason, "utf8"))
@@ -1584,44 +3925,24 @@ class AuthHandler(RequestHandler):
     def do_AUTHHEAD(self):
         """Request authorization."""
         LOG.info("Requesting authorization")
+        # The request body hasn't been read, the connection can't be reused
+        self.close_connection = True
         self.send_response(401)
         self.send_header('WWW-Authenticate', 'Basic realm=\"HASS Configurator\"')
         self.send_header('Content-type', 'text/html')
         self.end_headers()
 
     def do_GET(self):
-        if not verify_hostname(self.headers.get('Host', '')):
-            self.do_BLOCK(403, "Forbidden")
-            return
-        header = self.headers.get('Authorization', None)
-        if header is None:
-            self.do_AUTHHEAD()
-            self.wfile.write(bytes('no auth header received', 'utf-8'))
-        else:
-            authorization = header.split()
-            if len(authorization) == 2 and authorization[0] == "Basic":
-                plain = base64.b64decode(authorization[1]).decode("utf-8")
-                parts = plain.split(':')
-                username = parts[0]
-                password = ":".join(parts[1:])
-                if PASSWORD.startswith("{sha256}"):
-                    password = "{sha256}%s" % hashlib.sha256(password.encode("utf-8")).hexdigest()
-                if username == USERNAME and password == PASSWORD:
-                    if BANLIMIT:
-                        FAIL2BAN_IPS.pop(self.client_address[0], None)
-                    super().do_GET()
-                    return
-            if BANLIMIT:
-                bancounter = FAIL2BAN_IPS.get(self.client_address[0], 1)
-                if bancounter >= BANLIMIT:
-                    LOG.warning("Blocking access from %s", self.client_address[0])
-                    self.do_BLOCK()
-                    return
-                FAIL2BAN_IPS[self.client_address[0]] = bancounter + 1
-            self.do_AUTHHEAD()
-            self.wfile.write(bytes('Authentication required', 'utf-8'))
+        self.authorize(super().do_GET)
 
     def do_POST(self):
+        self.authorize(super().do_POST)
+
+    def do_PUT(self):
+        self.authorize(super().do_PUT)
+
+    def authorize(self, handle):
+        """Call handle if the request carries valid credentials."""
         if not verify_hostname(self.headers.get('Host', '')):
             self.do_BLOCK(403, "Forbidden")
             return
@@ -1639,9 +3960,10 @@ class AuthHandler(RequestHandler):
                 if PASSWORD.startswith("{sha256}"):
                     password = "{sha256}%s" % hashlib.sha256(password.encode("utf-8")).hexdigest()
                 if username == USERNAME and password == PASSWORD:
-                    if BANLIMIT:
-                        FAIL2BAN_IPS.pop(self.client_address[0], None)
-                    super().do_POST()
+                    if BANLIMIT and self.client_address[0] in FAIL2BAN_IPS:
+                        with SHARED_STATE:
+                            FAIL2BAN_IPS.pop(self.client_address[0], None)
+                    handle()
                     return
             if BANLIMIT:
                 bancounter = FAIL2BAN_IPS.get(self.client_address[0], 1)
@@ -1649,11 +3971,76 @@ class AuthHandler(RequestHandler):
                     LOG.warning("Blocking access from %s", self.client_address[0])
                     self.do_BLOCK()
                     return
-                FAIL2BAN_IPS[self.client_address[0]] = bancounter + 1
+                with SHARED_STATE:
+                    bancounter = FAIL2BAN_IPS.get(self.client_address[0], 1)
+                    FAIL2BAN_IPS[self.client_address[0]] = bancounter + 1
             self.do_AUTHHEAD()
             self.wfile.write(bytes('Authentication required', 'utf-8'))
 
-class SimpleServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+def build_router():
+    """Build the table of routes served by RequestHandler."""
+    router = Router()
+    for path, handler in (
+            ('/api/file', 'api_file'),
+            ('/api/download', 'api_download'),
+            ('/api/tail', 'api_tail'),
+            ('/api/listdir', 'api_listdir'),
+            ('/api/abspath', 'api_abspath'),
+            ('/api/parent', 'api_parent'),
+            ('/api/netstat', 'api_netstat'),
+            ('/api/bootstrap', 'api_bootstrap'),
+            ('/api/gitjob', 'api_gitjob'),
+            ('/api/upload_status', 'api_upload_status'),
+            ('/api/commands', 'api_commands'),
+            ('/api/command_output', 'api_command_output'),
+            ('/api/restart', 'api_restart'),
+            ('/api/check_config', 'api_check_config'),
+            ('/api/reload_automations', 'api_reload_automations'),
+            ('/api/reload_scripts', 'api_reload_scripts'),
+            ('/api/reload_groups', 'api_reload_groups'),
+            ('/api/reload_core', 'api_reload_core'),
+            ('/', 'serve_index')):
+        router.add('GET', path, handler)
+    for filename in STATIC_FILES:
+        router.add('GET', "/%s" % filename, 'serve_static')
+    for path, handler in (
+            ('/api/save', 'api_save'),
+            ('/api/upload', 'api_upload'),
+            ('/api/upload_init', 'api_upload_init'),
+            ('/api/upload_finalize', 'api_upload_finalize'),
+            ('/api/upload_abort', 'api_upload_abort'),
+            ('/api/rename', 'api_rename'),
+            ('/api/delete', 'api_delete'),
+            ('/api/exec_command', 'api_exec_command'),
+            ('/api/cancel_command', 'api_cancel_command'),
+            ('/api/gitadd', 'api_gitadd'),
+            ('/api/gitdiff', 'api_gitdiff'),
+            ('/api/commit', 'api_commit'),
+            ('/api/checkout', 'api_checkout'),
+            ('/api/newbranch', 'api_newbranch'),
+            ('/api/init', 'api_init'),
+            ('/api/push', 'api_push'),
+            ('/api/stash', 'api_stash'),
+            ('/api/newfolder', 'api_newfolder'),
+            ('/api/newfile', 'api_newfile'),
+            ('/api/allowed_networks', 'api_allowed_networks'),
+            ('/api/banned_ips', 'api_banned_ips')):
+        router.add('POST', path, handler)
+    router.add('PUT', '/api/upload_chunk', 'api_upload_chunk')
+    return router
+
+ROUTER = build_router()
+
+class ReusePortMixIn: # pylint: disable=too-few-public-methods
+    """Mix-in letting all processes bind the same port if PROCESSES > 1."""
+    # pylint: disable=no-member
+    def server_bind(self):
+        """Set SO_REUSEPORT before binding the socket."""
+        if PROCESSES > 1:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+class SimpleServer(ReusePortMixIn, socketserver.ThreadingMixIn, socketserver.TCPServer):
     """Server class."""
     daemon_threads = True
     allow_reuse_address = True
@@ -1661,41 +4048,348 @@ class SimpleServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     def __init__(self, server_address, RequestHandlerClass):
         socketserver.TCPServer.__init__(self, server_address, RequestHandlerClass)
 
+class PooledServer(ReusePortMixIn, socketserver.TCPServer):
+    """Server class handling connections with a fixed number of threads."""
+    allow_reuse_address = True
+    rejection = b"HTTP/1.0 503 Service Unavailable\r\n" \
+        b"Content-Type: text/plain\r\n" \
+        b"Content-Length: 19\r\n" \
+        b"Retry-After: 1\r\n" \
+        b"Connection: close\r\n\r\n" \
+        b"Service Unavailable"
+
+    def __init__(self, server_address, RequestHandlerClass, workers, queue_size):
+        self.request_queue_size = queue_size
+        socketserver.TCPServer.__init__(self, server_address, RequestHandlerClass)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.streams = threading.Semaphore(max(0, min(MAX_STREAMS, workers - 1)))
+        self._workers = []
+        for index in range(workers):
+            worker = threading.Thread(target=self._work, name="worker-%i" % index,
+                                      daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        """Handle queued connections until None is received."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        """Queue the connection or reject it if all workers are busy."""
+        try:
+            self._queue.put_nowait((request, client_address))
+        except queue.Full:
+            LOG.warning("Rejecting connection from %s: all workers busy",
+                        client_address[0])
+            try:
+                request.settimeout(1)
+                request.sendall(self.rejection)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def busy(self):
+        """Check if connections are waiting for a worker."""
+        return not self._queue.empty()
+
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        for _ in self._workers:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+
+class AsyncConnection: # pylint: disable=too-few-public-methods
+    """Stand-in for the socket of a connection served by AsyncServer."""
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def settimeout(self, timeout):
+        """Set the timeout used when waiting for the client."""
+        self.timeout = timeout
+
+class AsyncReader:
+    """File-like object reading from an asyncio stream within a handler thread."""
+    def __init__(self, loop, reader, connection, prefix=b""):
+        self.loop = loop
+        self.reader = reader
+        self.connection = connection
+        self.buffer = bytearray(prefix)
+
+    def _wait(self, coro):
+        """Run a coroutine on the event loop and wait for its result."""
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(coro, self.connection.timeout), self.loop)
+        try:
+            return future.result()
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out") from None
+
+    def _take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        """Read size bytes, or everything until the client closes the stream."""
+        if size is None or size < 0:
+            return self._take(len(self.buffer)) + self._wait(self.reader.read())
+        if len(self.buffer) < size:
+            try:
+                self.buffer += self._wait(self.reader.readexactly(size - len(self.buffer)))
+            except asyncio.IncompleteReadError as err:
+                self.buffer += err.partial
+        return self._take(size)
+
+    def readline(self, size=-1):
+        """Read a line, limited to size bytes."""
+        if b"\n" not in self.buffer and (size < 0 or len(self.buffer) < size):
+            self.buffer += self._wait(self.reader.readline())
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        if 0 <= size < end:
+            end = size
+        return self._take(end)
+
+class AsyncWriter:
+    """File-like object writing to an asyncio stream within a handler thread."""
+    def __init__(self, loop, writer, connection):
+        self.loop = loop
+        self.writer = writer
+        self.connection = connection
+
+    async def write_async(self, data):
+        """Write data from a coroutine running on the event loop."""
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.connection.timeout)
+
+    def write(self, data):
+        """Write data and wait until the transport has accepted it."""
+        asyncio.run_coroutine_threadsafe(self.write_async(bytes(data)), self.loop).result()
+        return len(data)
+
+    def flush(self):
+        """Data is flushed on every write."""
+
+class AsyncServer:
+    """Server waiting for clients on an event loop and running the request
+    handlers in a pool of threads."""
+    address_family = socket.AF_INET
+    max_head_size = 65536
+    prefetch_size = 65536
+
+    # pylint: disable=invalid-name
+    def __init__(self, server_address, RequestHandlerClass, workers, queue_size):
+        self.RequestHandlerClass = RequestHandlerClass
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self.ssl_context = None
+        if SSL_CERTIFICATE:
+            # TLS handshakes are done by the event loop
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ssl_context.load_cert_chain(SSL_CERTIFICATE, SSL_KEY)
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="worker")
+        self.socket = socket.socket(self.address_family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if PROCESSES > 1:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(queue_size)
+        self.server_address = self.socket.getsockname()
+
+    def serve_forever(self):
+        """Accept and serve connections until the server is closed."""
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(asyncio.start_server(
+            self._serve_connection, sock=self.socket, ssl=self.ssl_context,
+            limit=self.max_head_size))
+        self.loop.run_forever()
+
+    def server_close(self):
+        """Stop accepting connections and release the handler threads."""
+        self.socket.close()
+        self.executor.shutdown(wait=False)
+
+    def busy(self):
+        """Check if requests are waiting for a handler thread."""
+        return self.pending > self.workers
+
+    async def _read_head(self, reader):
+        """Read the request line and headers of the next request."""
+        line = await asyncio.wait_for(reader.readline(), CONNECTION_IDLE_TIMEOUT)
+        if not line:
+            return None
+        head = [line]
+        size = len(line)
+        while line not in (b"\r\n", b"\n", b""):
+            line = await asyncio.wait_for(reader.readline(), CONNECTION_READ_TIMEOUT)
+            size += len(line)
+            if size > self.max_head_size:
+                raise ValueError("Request headers too large")
+            head.append(line)
+        return b"".join(head)
+
+    async def _serve_connection(self, reader, writer):
+        """Read requests from a connection and hand them to the handler threads."""
+        client_address = writer.get_extra_info('peername')
+        if self.RequestHandlerClass.disable_nagle_algorithm:
+            writer.get_extra_info('socket').setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        try:
+            while True:
+                head = await self._read_head(reader)
+                if head is None:
+                    break
+                if self.pending >= self.workers + self.queue_size:
+                    LOG.warning("Rejecting request from %s: all workers busy",
+                                client_address[0])
+                    writer.write(PooledServer.rejection)
+                    await asyncio.wait_for(writer.drain(), CONNECTION_IDLE_TIMEOUT)
+                    break
+                headers = http.client.parse_headers(io.BytesIO(head.split(b"\n", 1)[-1]))
+                length = int(headers.get('content-length', 0) or 0)
+                if 0 < length <= self.prefetch_size:
+                    # Small bodies are received before a thread is involved
+                    head += await asyncio.wait_for(reader.readexactly(length),
+                                                   CONNECTION_READ_TIMEOUT)
+                self.pending += 1
+                try:
+                    handler = await self.loop.run_in_executor(
+                        self.executor, self._handle_request, head, reader, writer,
+                        client_address)
+                finally:
+                    self.pending -= 1
+                if handler.deferred is not None:
+                    # Finish the request on the event loop, without a thread
+                    await handler.deferred
+                if handler.close_connection:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as err:
+            LOG.warning(err)
+        finally:
+            writer.close()
+
+    def _handle_request(self, head, reader, writer, client_address):
+        """Run the request handler for one request and return it."""
+        connection = AsyncConnection(CONNECTION_READ_TIMEOUT)
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.server = self
+        handler.client_address = client_address
+        handler.request = handler.connection = connection
+        handler.rfile = AsyncReader(self.loop, reader, connection, head)
+        handler.wfile = AsyncWriter(self.loop, writer, connection)
+        handler.close_connection = True
+        handler.handle_one_request()
+        return handler
+
 def notify(title="HASS Configurator",
            message="Notification by HASS Configurator",
            notification_id=None):
     """Helper function to send notifications via HASS."""
     if not HASS_API or not NOTIFY_SERVICE:
         return
-    headers = {
-        "Content-Type": "application/json"
-    }
     data = {
         "title": title,
         "message": message
     }
     if notification_id and NOTIFY_SERVICE == NOTIFY_SERVICE_DEFAULT:
         data["notification_id"] = notification_id
-    if HASS_API_PASSWORD:
-        if is_jwt(HASS_API_PASSWORD):
-            headers["Authorization"] = "Bearer %s" % HASS_API_PASSWORD
-        else:
-            headers["x-ha-access"] = HASS_API_PASSWORD
-    req = urllib.request.Request(
-        "%sservices/%s" % (HASS_API, NOTIFY_SERVICE.replace('.', '/')),
-        data=bytes(json.dumps(data).encode('utf-8')),
-        headers=headers, method='POST')
     LOG.info("%s", data)
     try:
-        with urllib.request.urlopen(req) as response:
-            message = response.read().decode('utf-8')
-            LOG.debug(message)
+        message = hass_api_request(
+            'POST', "services/%s" % NOTIFY_SERVICE.replace('.', '/'), data,
+            timeout=HASS_SERVICE_TIMEOUT)
+        LOG.debug(message)
     except Exception as err:
         LOG.warning("Exception while creating notification: %s", err)
 
+def serve(primary=True):
+    """Start the server and handle requests until it's shut down. Only the
+    primary process talks to HASS in the background."""
+    global HTTPD, INDEX_TEMPLATE
+    if SERVER_ENGINE == "asyncio":
+        custom_server = AsyncServer
+    else:
+        custom_server = PooledServer if WORKERS else SimpleServer
+    if ':' in LISTENIP:
+        custom_server.address_family = socket.AF_INET6
+    server_address = (LISTENIP, PORT)
+    if USERNAME and PASSWORD:
+        handler = AuthHandler
+    else:
+        handler = RequestHandler
+    if custom_server is AsyncServer:
+        HTTPD = custom_server(server_address, handler, WORKERS or 16, MAX_QUEUED_CONNECTIONS)
+    elif WORKERS:
+        HTTPD = custom_server(server_address, handler, WORKERS, MAX_QUEUED_CONNECTIONS)
+    else:
+        HTTPD = custom_server(server_address, handler)
+    if SSL_CERTIFICATE and custom_server is not AsyncServer:
+        HTTPD.socket = ssl.wrap_socket(HTTPD.socket,
+                                       certfile=SSL_CERTIFICATE,
+                                       keyfile=SSL_KEY,
+                                       server_side=True)
+    LOG.info('Listening on: %s://%s:%i',
+             'https' if SSL_CERTIFICATE else 'http',
+             HTTPD.server_address[0], HTTPD.server_address[1])
+    if not DEV:
+        load_static_files()
+        INDEX_TEMPLATE = compile_index_template()
+    if HASS_API and primary:
+        BOOTSTRAP.refresh_async()
+        if LIVE_REGISTRY and HASS_API_PASSWORD:
+            REGISTRY.start()
+        if SHARED_STATE.store is not None:
+            threading.Thread(target=publish_bootstrap, name="bootstrap-publisher",
+                             daemon=True).start()
+    HTTPD.serve_forever()
+
+def serve_worker(index):
+    """Run the server in a worker process."""
+    global HASS_POOL
+    # Connections of the parent process can't be shared
+    HASS_POOL = None
+    LOG.info("Worker process %i started (pid %i)", index, os.getpid())
+    BOOTSTRAP.shared = index != 0
+    serve(primary=index == 0)
+
+def serve_processes():
+    """Run PROCESSES worker processes and restart them if they fail."""
+    signal.signal(signal.SIGTERM, signal_handler)
+    context = multiprocessing.get_context("fork")
+    SHARED_STATE.attach(context)
+    workers = {}
+    while True:
+        for index in range(PROCESSES):
+            worker = workers.get(index)
+            if worker is not None and worker.is_alive():
+                continue
+            if worker is not None:
+                LOG.warning("Worker process %i exited with code %s. Restarting.",
+                            index, worker.exitcode)
+            worker = context.Process(target=serve_worker, args=(index,),
+                                     name="worker-process-%i" % index, daemon=True)
+            worker.start()
+            workers[index] = worker
+        time.sleep(1)
+
 def main():
     """Main function, duh!"""
-    global HTTPD
     signal.signal(signal.SIGINT, signal_handler)
     parser = argparse.ArgumentParser(description="Visit " \
     "https://github.com/danielperna84/hass-configurator for more details " \
@@ -1789,26 +4483,12 @@ def main():
     except Exception as err:
         LOG.warning("Exception while checking passwords: %s", err)
 
-    custom_server = SimpleServer
-    if ':' in LISTENIP:
-        custom_server.address_family = socket.AF_INET6
-    server_address = (LISTENIP, PORT)
-    if USERNAME and PASSWORD:
-        handler = AuthHandler
-    else:
-        handler = RequestHandler
-    HTTPD = custom_server(server_address, handler)
-    if SSL_CERTIFICATE:
-        HTTPD.socket = ssl.wrap_socket(HTTPD.socket,
-                                       certfile=SSL_CERTIFICATE,
-                                       keyfile=SSL_KEY,
-                                       server_side=True)
-    LOG.info('Listening on: %s://%s:%i',
-             'https' if SSL_CERTIFICATE else 'http',
-             HTTPD.server_address[0], HTTPD.server_address[1])
     if BASEPATH:
         os.chdir(BASEPATH)
-    HTTPD.serve_forever()
+    if PROCESSES > 1:
+        serve_processes()
+    else:
+        serve()
 
 if __name__ == "__main__":
     main()
@@ -21,6 +21,7 @@ setup(name=NAME,
       author_email='danielperna84@gmail.com',
       license='MIT',
       install_requires=['pyotp', 'gitpython'],
+      extras_require={'brotli': ['brotli']},
       packages=[PACKAGE_NAME],
       include_package_data=True,
       entry_points={